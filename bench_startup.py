@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Startup time of the extractor
+#
+# Times `import google_analytics` and `google_analytics.py --help` in fresh
+# interpreters and fails when the median import time is over budget, so a
+# top-level import of pandas, sqlalchemy or googleapiclient creeping back in
+# shows up before it slows every cron run down.
+#
+# Run with `python bench_startup.py [-n RUNS] [--budget MS]`. `python -X
+# importtime -c "import google_analytics"` shows where the time goes.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Median `import google_analytics` time allowed, in milliseconds
+IMPORT_BUDGET_MS = 150
+RUNS = 7
+# Modules the extractor must not import at startup
+HEAVY_MODULES = ['pandas', 'numpy', 'sqlalchemy', 'googleapiclient', 'oauth2client', 'httpx']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def timeCommand(args, runs=RUNS):
+    """Returns the median wall time of a command, in milliseconds."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def heavyImports():
+    """Returns the heavy modules loaded by `import google_analytics`."""
+    check = ('import sys, google_analytics; '
+             'print(" ".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,))
+    out = subprocess.run([sys.executable, '-c', check], cwd=HERE, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return out.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark extractor startup time.')
+    parser.add_argument('-n', '--runs', type=int, default=RUNS)
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS,
+                        help='median import time allowed, in ms')
+    args = parser.parse_args(argv)
+
+    baseline = timeCommand([sys.executable, '-c', 'pass'], args.runs)
+    imported = timeCommand([sys.executable, '-c', 'import google_analytics'], args.runs)
+    helpText = timeCommand([sys.executable, 'google_analytics.py', '--help'], args.runs)
+    heavy = heavyImports()
+
+    print('interpreter          %7.1f ms' % baseline)
+    print('import               %7.1f ms (%+.1f)' % (imported, imported - baseline))
+    print('google_analytics -h  %7.1f ms (%+.1f)' % (helpText, helpText - baseline))
+    print('heavy modules        %s' % (', '.join(heavy) or 'none'))
+
+    failed = False
+    if imported - baseline > args.budget:
+        print('FAIL: import takes %.1f ms over a bare interpreter, budget is %.0f ms'
+              % (imported - baseline, args.budget))
+        failed = True
+    if heavy:
+        print('FAIL: imported at startup: %s' % ', '.join(heavy))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Merging rows repeated across the date ranges of a month
+#
+# When getMonthData has to split a month into several date ranges, each
+# range returns its own row for the same dimensions (the month is a
+# dimension, the day isn't), so without merging a table holds one row per
+# range. Within a single date range GA never repeats a dimension tuple, so a
+# repeat there can only come from a page that was stored twice, and it is
+# dropped instead.
+#
+# Across ranges, additive metrics are summed. Non-additive ones
+# (NON_ADDITIVE_METRICS, ga:users) can't be: a user active in both halves of
+# the month would be counted twice. Those keep the largest single-range
+# value, which is a lower bound, and the merges that affected them are
+# counted so the run log can flag them.
+#
+# Date ranges are taken one at a time, and each group remembers the last
+# range that added to it, which is how a repeat within a range is told from
+# a row of the next one. Groups are kept in a dict until there are
+# MAX_GROUPS of them. After that they are spilled to hash-partitioned files
+# and each partition is merged on its own and its rows handed on before the
+# next one is read, so memory stays bounded however many ranges and rows
+# there are.
+
+import os
+import tempfile
+import zlib
+
+from ga_reports import NON_ADDITIVE_METRICS
+from ga_transport import dumps, loads
+
+MAX_GROUPS = 500000
+SPILL_PARTITIONS = 16
+
+
+def addValues(a, b):
+    try:
+        return str(int(a) + int(b))
+    except ValueError:
+        return repr(float(a) + float(b))
+
+
+def maxValue(a, b):
+    return a if float(a) >= float(b) else b
+
+
+class RowAggregator(object):
+    """Merges the rows of a partition's date ranges by dimension tuple.
+
+    Args:
+        spec: Report spec (or ga_merge merged spec) the rows were fetched with
+        maxGroups: Groups held in memory before spilling to disk
+        spillDir: Directory for spill files, the system temp dir by default
+    """
+
+    def __init__(self, spec, maxGroups=MAX_GROUPS, spillDir=None):
+        self.additive = [m not in NON_ADDITIVE_METRICS for m in spec['metrics']]
+        self.maxGroups = maxGroups
+        self.spillDir = spillDir
+        # dimensions -> (last date range added, metric values)
+        self.groups = {}
+        self.window = -1
+        self.stats = {'rows': 0, 'windows': 0, 'duplicates': 0, 'merged': 0,
+                      'non_additive': 0, 'spilled': 0}
+        self._spill = None
+        self._files = None
+
+    def combine(self, old, new):
+        """Merges the metric values of two rows with the same dimensions."""
+        self.stats['merged'] += 1
+        if not all(self.additive):
+            self.stats['non_additive'] += 1
+        return tuple([addValues(a, b) if additive else maxValue(a, b)
+                      for additive, a, b in zip(self.additive, old, new)])
+
+    def merge(self, groups, dimensions, window, values):
+        """Adds the values of one row of date range `window` to `groups`."""
+        old = groups.get(dimensions)
+        if old is None:
+            groups[dimensions] = (window, values)
+        elif old[0] == window:
+            # Repeated within one date range: a page that was stored twice
+            self.stats['duplicates'] += 1
+        else:
+            groups[dimensions] = (window, self.combine(old[1], values))
+
+    def addWindow(self, rows):
+        """Adds the rows of the next date range."""
+        self.window += 1
+        self.stats['windows'] += 1
+        for dimensions, values in rows:
+            self.stats['rows'] += 1
+            self.merge(self.groups, dimensions, self.window, values)
+            if len(self.groups) >= self.maxGroups:
+                self.spill()
+        if self._files is not None:
+            # Once spilling, no group in memory spans two ranges: a repeat of a
+            # row spilled earlier in this range then can't be merged into the
+            # next range's row before the partition files tell them apart
+            self.spill()
+
+    def spill(self):
+        """Moves the in-memory groups to the partition files."""
+        if self._files is None:
+            self._spill = tempfile.TemporaryDirectory(prefix='ga_aggregate', dir=self.spillDir)
+            self._files = [open(os.path.join(self._spill.name, '%02d' % i), 'w+b')
+                           for i in range(SPILL_PARTITIONS)]
+        for dimensions, (window, values) in self.groups.items():
+            partition = zlib.crc32('\x1f'.join(dimensions).encode('utf-8')) % SPILL_PARTITIONS
+            self._files[partition].write(dumps([dimensions, window, values]) + b'\n')
+        self.stats['spilled'] += len(self.groups)
+        self.groups = {}
+
+    def rows(self):
+        """Yields the merged rows. The aggregator can't be used afterwards."""
+        if self._files is None:
+            groups, self.groups = self.groups, {}
+            for dimensions, (window, values) in groups.items():
+                yield dimensions, values
+            return
+
+        self.spill()
+        try:
+            for f in self._files:
+                f.seek(0)
+                groups = {}
+                for line in f:
+                    dimensions, window, values = loads(line)
+                    self.merge(groups, tuple(dimensions), window, tuple(values))
+                for dimensions, (window, values) in groups.items():
+                    yield dimensions, values
+                groups = None
+        finally:
+            for f in self._files:
+                f.close()
+            self._spill.cleanup()
+            self._files = None
+
+
+def mergeWindows(spec, windows, **kwargs):
+    """Merges the rows of a partition's date ranges.
+
+    Args:
+        spec: Report spec the rows were fetched with
+        windows: Iterable of each date range's rows, taken one range at a time
+        kwargs: Passed to RowAggregator
+    Returns:
+        (rows, stats): an iterable of the merged rows and a dict counting
+        input rows, date ranges, dropped duplicates, merged rows, merges
+        involving non-additive metrics and spilled groups. The counts are
+        final once the rows have been consumed.
+    """
+    windows = iter(windows)
+    first = next(windows, None)
+    second = next(windows, None)
+    if first is None:
+        return [], {'rows': 0, 'windows': 0, 'duplicates': 0, 'merged': 0, 'non_additive': 0,
+                    'spilled': 0}
+    if second is None and len(first) <= kwargs.get('maxGroups', MAX_GROUPS):
+        # The common case: nothing to merge, only look for a page stored twice
+        if len(set(dimensions for dimensions, values in first)) == len(first):
+            return first, {'rows': len(first), 'windows': 1, 'duplicates': 0, 'merged': 0,
+                           'non_additive': 0, 'spilled': 0}
+
+    aggregator = RowAggregator(spec, **kwargs)
+    aggregator.addWindow(first)
+    first = None
+    if second is not None:
+        aggregator.addWindow(second)
+        second = None
+        for rows in windows:
+            aggregator.addWindow(rows)
+    return aggregator.rows(), aggregator.stats
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Async Analytics Reporting API V4 client
+#
+# `analytics.reports().batchGet(...).execute()` blocks for the whole round
+# trip, so the sync fetchers handle one request at a time. This client posts
+# the same batchGet bodies (built from ga_reports.REPORTS) over one HTTP/2
+# connection with httpx, so many (report, month, page) requests overlap on a
+# single core. Requests go through the run's ga_quota.QuotaScheduler, which
+# spaces them and charges them against GA's daily quotas. Requests and
+# responses use the gzip/partial-response format from ga_transport.
+#
+# google_analytics.py --async fetches every partition of a run that isn't
+# checkpointed yet with prefetchPartitions() before the usual fetch: each
+# page lands in the checkpoint and the partition is marked finished with
+# the date ranges it took, so the sync path replays it through the same
+# merges, targets and ga_aggregate merging as anything it fetched itself.
+# A date range GA samples is fetched again in halves; any other error
+# leaves the partition to the sync fetch.
+
+import asyncio
+import datetime as dt
+import random
+
+import httpx
+
+from ga_quota import VIEW_CONCURRENT_REQUESTS, QuotaExhausted, QuotaScheduler, datePriority
+from ga_reports import batchGetBody
+from ga_rows import compactRows
+from ga_transport import RESPONSE_FIELDS, USER_AGENT, dumps, loads
+from ga_validate import windowMeta
+
+BATCH_GET_URL = 'https://analyticsreporting.googleapis.com/v4/reports:batchGet'
+HTTP_TIMEOUT = 300
+MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 503)
+
+
+class SampledRange(Exception):
+    """GA sampled a date range that can still be split."""
+
+
+class AsyncReportingClient(object):
+    """Asyncio Reporting API V4 client for a single view.
+
+    Args:
+        pool: ga_client.ClientPool supplying OAuth access tokens
+        viewId: GA view to query
+        scheduler: ga_quota.QuotaScheduler shared by the run
+        concurrency: Maximum requests in flight
+    """
+
+    def __init__(self, pool, viewId, scheduler=None, concurrency=VIEW_CONCURRENT_REQUESTS):
+        self.pool = pool
+        self.viewId = viewId
+        self.scheduler = scheduler or QuotaScheduler()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._client = httpx.AsyncClient(
+            http2=True, timeout=HTTP_TIMEOUT,
+            headers={'Accept-Encoding': 'gzip', 'User-Agent': USER_AGENT},
+            params={'fields': RESPONSE_FIELDS},
+            limits=httpx.Limits(max_connections=concurrency,
+                                max_keepalive_connections=concurrency))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _accessToken(self, force=False):
+        # Token refresh is a blocking oauth2client call, keep it off the loop
+        loop = asyncio.get_running_loop()
+        if force:
+            await loop.run_in_executor(None, self.pool.refreshToken, True)
+        return await loop.run_in_executor(None, self.pool.accessToken)
+
+    async def batchGet(self, body, priority, report=None):
+        """Posts a reports:batchGet request, retrying rate limit and server errors.
+
+        Args:
+            body: batchGet request body
+            priority: ga_quota priority of the request
+            report: Report name, for the scheduler's usage summary
+        Returns:
+            The decoded Analytics Reporting API V4 response.
+        """
+        loop = asyncio.get_running_loop()
+        status = None
+        for attempt in range(MAX_RETRIES):
+            await loop.run_in_executor(None, self.scheduler.acquire, self.viewId, priority, report)
+            token = await self._accessToken(force=status == 401)
+
+            async with self._semaphore:
+                resp = await self._client.post(
+                    BATCH_GET_URL, content=dumps(body),
+                    headers={'Authorization': 'Bearer %s' % token,
+                             'Content-Type': 'application/json'})
+
+            status = resp.status_code
+            if status == 200:
+                return loads(resp.content)
+            if status == 429:
+                self.scheduler.throttled()
+            if status in RETRY_STATUSES:
+                await asyncio.sleep(2 ** attempt + random.random())
+            elif status != 401:
+                break
+
+        resp.raise_for_status()
+
+    async def _page(self, spec, s_dt, e_dt, token):
+        response = await self.batchGet(batchGetBody(spec, self.viewId, s_dt, e_dt, token),
+                                       datePriority(s_dt), spec['name'])
+        return response['reports'][0]
+
+    async def fetchWindow(self, spec, s_dt, e_dt, unsampled=False):
+        """Fetches every page of a report for a date range.
+
+        GA page tokens are row offsets, so once the first page reports the
+        row count the remaining pages are requested concurrently. Any other
+        token format falls back to following nextPageToken one page at a time.
+
+        Args:
+            spec: Report spec (or ga_merge/ga_targets spec) to fetch
+            s_dt: Start Date
+            e_dt: End Date
+            unsampled: Raise SampledRange rather than fetch a sampled range
+        Returns:
+            (the first page's report, [(rows, nextPageToken)] for each page
+            in page order), rows as ga_rows tuples.
+        """
+        first = await self._page(spec, s_dt, e_dt, None)
+        if unsampled and first['data'].get('samplingSpaceSizes'):
+            raise SampledRange('%s %s..%s is sampled' % (spec['name'], s_dt, e_dt))
+        token = first.get('nextPageToken')
+        pages = [(compactRows(spec, first['data'].get('rows', [])), token)]
+
+        if token and token.isdigit():
+            rowCount = first['data'].get('rowCount', 0)
+            # The first token is the size of a page
+            reports = await asyncio.gather(*[self._page(spec, s_dt, e_dt, str(offset))
+                                             for offset in range(int(token), rowCount, int(token))])
+            for report in reports:
+                pages.append((compactRows(spec, report['data'].get('rows', [])),
+                              report.get('nextPageToken')))
+        else:
+            while token:
+                report = await self._page(spec, s_dt, e_dt, token)
+                token = report.get('nextPageToken')
+                pages.append((compactRows(spec, report['data'].get('rows', [])), token))
+
+        return first, pages
+
+    async def fetchWindows(self, spec, start, end):
+        """Fetches a date range, in halves for as long as GA samples it.
+
+        Only sampling splits a range; any other error is raised. A single
+        day is kept even if it is sampled, and ga_validate flags it.
+
+        Args:
+            spec: Report spec to fetch
+            start: First day, datetime.date
+            end: Last day, datetime.date
+        Returns:
+            [(s_dt, e_dt, first page's report, pages)] for each range fetched,
+            in date order, see fetchWindow.
+        """
+        s_dt, e_dt = start.isoformat(), end.isoformat()
+        try:
+            first, pages = await self.fetchWindow(spec, s_dt, e_dt, unsampled=start < end)
+        except SampledRange:
+            mid = start + (end - start) // 2
+            left, right = await asyncio.gather(
+                self.fetchWindows(spec, start, mid),
+                self.fetchWindows(spec, mid + dt.timedelta(days=1), end))
+            return left + right
+        return [(s_dt, e_dt, first, pages)]
+
+    async def fetchPartition(self, spec, year, month, lastDay, checkpoint):
+        """Fetches a month into the checkpoint and marks it finished.
+
+        The month's rows are not returned: google_analytics.getPartitionData
+        replays its date ranges from the checkpoint and merges them.
+
+        Args:
+            spec: Spec the month is fetched with, see google_analytics.fetchSpec
+            year: Year
+            month: Month
+            lastDay: Last day of the month to fetch
+            checkpoint: ga_checkpoint.CheckpointStore of the run
+        """
+        windows = await self.fetchWindows(spec, dt.date(year, month, 1),
+                                          dt.date(year, month, lastDay))
+        await asyncio.get_running_loop().run_in_executor(
+            None, savePartition, checkpoint, spec, year, month, windows)
+
+
+def savePartition(checkpoint, spec, year, month, windows):
+    """Stores the date ranges fetchWindows() fetched for a month, replacing anything stored for it."""
+    checkpoint.forget(spec['name'], year, month)
+    for s_dt, e_dt, first, pages in windows:
+        checkpoint.saveWindowMeta(spec['name'], s_dt, e_dt, windowMeta(spec, first))
+        for i, (rows, token) in enumerate(pages):
+            checkpoint.savePage(spec['name'], s_dt, e_dt, rows,
+                                token if i < len(pages) - 1 else None)
+    checkpoint.markPartition(spec['name'], year, month,
+                             [(s_dt, e_dt) for s_dt, e_dt, first, pages in windows])
+
+
+async def fetchPartitions(pool, partitions, checkpoint, viewId, **kwargs):
+    """Fetches (spec, year, month, lastDay) partitions concurrently into the checkpoint.
+
+    Partitions of the open month are started first so they reach the
+    scheduler ahead of backfill. Each view gets a client of its own.
+
+    Args:
+        pool: ga_client.ClientPool
+        partitions: List of (spec, year, month, lastDay) tuples
+        checkpoint: ga_checkpoint.CheckpointStore of the run
+        viewId: View of specs without a 'viewId'
+        kwargs: Passed to AsyncReportingClient
+    Returns:
+        A list of (partition, exception) for the partitions that failed.
+    Raises:
+        QuotaExhausted: The daily quota of a view ran out.
+    """
+    partitions = sorted(partitions, key=lambda p: datePriority('%04d-%02d-01' % p[1:3]))
+    clients = {}
+    try:
+        for spec, year, month, lastDay in partitions:
+            view = spec.get('viewId', viewId)
+            if view not in clients:
+                clients[view] = AsyncReportingClient(pool, view, **kwargs)
+        results = await asyncio.gather(
+            *[clients[spec.get('viewId', viewId)].fetchPartition(spec, year, month, lastDay,
+                                                                 checkpoint)
+              for spec, year, month, lastDay in partitions],
+            return_exceptions=True)
+    finally:
+        for client in clients.values():
+            await client.aclose()
+    for result in results:
+        if isinstance(result, QuotaExhausted):
+            raise result
+    return [(partition, result) for partition, result in zip(partitions, results)
+            if isinstance(result, Exception)]
+
+
+def prefetchPartitions(pool, partitions, checkpoint, viewId, **kwargs):
+    """Blocking wrapper around fetchPartitions()."""
+    return asyncio.run(fetchPartitions(pool, partitions, checkpoint, viewId, **kwargs))
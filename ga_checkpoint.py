@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Checkpoints for long backfills
+#
+# Every page fetched from the API is written to a SQLite file together with
+# the nextPageToken that follows it, in one transaction. A run started in
+# resume mode reads finished date ranges back from the file, continues
+# in-flight ones from their saved token, replays the date-range decisions
+# getMonthData made for finished (report, month) partitions, and leaves
+# tables that were already loaded alone. A failure then only costs the pages
+# and loads that hadn't been checkpointed yet. Each date range also keeps the
+# totals and sampling counts GA reported for it, for ga_validate. The
+# intraday command keeps today's rows here too, one entry per hour.
+
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+
+from ga_transport import dumps, loads
+
+FETCHING = 'fetching'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+create table if not exists windows (
+    report text, s_dt text, e_dt text, status text, next_token text, pages integer,
+    primary key (report, s_dt, e_dt));
+create table if not exists pages (
+    report text, s_dt text, e_dt text, page integer, rows blob,
+    primary key (report, s_dt, e_dt, page));
+create table if not exists partitions (
+    report text, month text, windows text, updated text,
+    primary key (report, month));
+create table if not exists loads (
+    report text primary key, updated text);
+create table if not exists window_meta (
+    report text, s_dt text, e_dt text, meta text,
+    primary key (report, s_dt, e_dt));
+create table if not exists hours (
+    report text, hour text, rows blob,
+    primary key (report, hour));
+create table if not exists partition_runs (
+    report text, month text, run text,
+    primary key (report, month));
+'''
+TABLES = ('windows', 'pages', 'window_meta', 'partitions', 'loads', 'hours', 'partition_runs')
+# Today's hours belong to the intraday command, which drops earlier days
+# itself: a backfill or extract starting over leaves them alone
+RESET_TABLES = tuple(table for table in TABLES if table != 'hours')
+
+
+class CheckpointStore(object):
+    """Durable record of fetched pages, finished partitions and loaded tables.
+
+    Args:
+        directory: Directory holding checkpoint.db
+        reset: Start from an empty checkpoint instead of resuming, today's
+            intraday hours aside
+    """
+
+    def __init__(self, directory, reset=False):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'checkpoint.db')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('pragma journal_mode=wal')
+        self._db.executescript(SCHEMA)
+        if reset:
+            self.reset()
+
+    def reset(self, reports=None):
+        """Forgets everything recorded so far but today's hours, or only what was recorded for `reports`."""
+        with self._lock, self._db:
+            for table in RESET_TABLES:
+                if reports is None:
+                    self._db.execute('delete from %s' % table)
+                else:
+                    self._db.executemany('delete from %s where report=?' % table,
+                                         [(r,) for r in reports])
+
+    def forget(self, report, year, month):
+        """Forgets one (report, month) partition so it is fetched again."""
+        month = '%04d-%02d' % (year, month)
+        with self._lock, self._db:
+            for table in ('windows', 'pages', 'window_meta'):
+                self._db.execute("delete from %s where report=? and substr(s_dt, 1, 7)=?" % table,
+                                 (report, month))
+            self._db.execute('delete from partitions where report=? and month=?', (report, month))
+            self._db.execute('delete from loads where report=?', (report,))
+
+    def pagesPerPartition(self, report):
+        """Returns the average pages fetched per finished partition of a report, None if unknown."""
+        with self._lock:
+            partitions = self._db.execute('select windows from partitions where report=?',
+                                          (report,)).fetchall()
+            if not partitions:
+                return None
+            pages = 0
+            for windows, in partitions:
+                for s_dt, e_dt in json.loads(windows):
+                    row = self._db.execute(
+                        'select pages from windows where report=? and s_dt=? and e_dt=?',
+                        (report, s_dt, e_dt)).fetchone()
+                    pages += row[0] if row else 1
+            return float(pages) / len(partitions)
+
+    def _pageRows(self, report, s_dt, e_dt):
+        rows = []
+        for blob, in self._db.execute(
+                'select rows from pages where report=? and s_dt=? and e_dt=? order by page',
+                (report, s_dt, e_dt)):
+            rows.extend(loads(zlib.decompress(blob)))
+        return rows
+
+    def windowStatus(self, report, s_dt, e_dt):
+        """Returns FETCHING, DONE, FAILED or None for a report's date range."""
+        with self._lock:
+            row = self._db.execute(
+                'select status from windows where report=? and s_dt=? and e_dt=?',
+                (report, s_dt, e_dt)).fetchone()
+        return row[0] if row else None
+
+    def window(self, report, s_dt, e_dt):
+        """Returns where to pick up a report's date range.
+
+        Args:
+            report: Report name
+            s_dt: Start Date
+            e_dt: End Date
+        Returns:
+            (status, nextPageToken, rows already fetched). A FAILED range
+            starts over, so it comes back as (None, None, []).
+        """
+        with self._lock:
+            row = self._db.execute(
+                'select status, next_token from windows where report=? and s_dt=? and e_dt=?',
+                (report, s_dt, e_dt)).fetchone()
+            if row is None:
+                return None, None, []
+            status, token = row
+            if status == FAILED:
+                with self._db:
+                    self._db.execute('delete from windows where report=? and s_dt=? and e_dt=?',
+                                     (report, s_dt, e_dt))
+                    self._db.execute('delete from pages where report=? and s_dt=? and e_dt=?',
+                                     (report, s_dt, e_dt))
+                    self._db.execute('delete from window_meta where report=? and s_dt=? and e_dt=?',
+                                     (report, s_dt, e_dt))
+                return None, None, []
+            return status, token, self._pageRows(report, s_dt, e_dt)
+
+    def savePage(self, report, s_dt, e_dt, rows, nextToken):
+        """Stores a fetched page and the token of the page after it.
+
+        Args:
+            report: Report name
+            s_dt: Start Date
+            e_dt: End Date
+            rows: The page's rows
+            nextToken: nextPageToken, None on the last page
+        """
+        blob = zlib.compress(dumps(rows))
+        status = FETCHING if nextToken else DONE
+        with self._lock, self._db:
+            row = self._db.execute(
+                'select pages from windows where report=? and s_dt=? and e_dt=?',
+                (report, s_dt, e_dt)).fetchone()
+            page = row[0] if row else 0
+            self._db.execute('insert or replace into pages values (?, ?, ?, ?, ?)',
+                             (report, s_dt, e_dt, page, blob))
+            self._db.execute('insert or replace into windows values (?, ?, ?, ?, ?, ?)',
+                             (report, s_dt, e_dt, status, nextToken, page + 1))
+
+    def saveWindowMeta(self, report, s_dt, e_dt, meta):
+        """Stores what GA reported about a whole date range (totals, sampling)."""
+        with self._lock, self._db:
+            self._db.execute('insert or replace into window_meta values (?, ?, ?, ?)',
+                             (report, s_dt, e_dt, json.dumps(meta)))
+
+    def windowMeta(self, report, s_dt, e_dt):
+        """Returns the meta saved for a date range, None if there is none."""
+        with self._lock:
+            row = self._db.execute(
+                'select meta from window_meta where report=? and s_dt=? and e_dt=?',
+                (report, s_dt, e_dt)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def failWindow(self, report, s_dt, e_dt):
+        """Records that getMonthData gave up on a date range."""
+        with self._lock, self._db:
+            self._db.execute(
+                'insert or replace into windows values (?, ?, ?, ?, ?, '
+                'coalesce((select pages from windows where report=? and s_dt=? and e_dt=?), 0))',
+                (report, s_dt, e_dt, FAILED, None, report, s_dt, e_dt))
+
+    def markPartition(self, report, year, month, windows):
+        """Records a finished (report, month) partition and the date ranges it was fetched in."""
+        with self._lock, self._db:
+            self._db.execute('insert or replace into partitions values (?, ?, ?, ?)',
+                             (report, '%04d-%02d' % (year, month), json.dumps(windows),
+                              datetime.now().isoformat()))
+
+    def partitionRun(self, report, year, month):
+        """Returns the ga_queue run a partition was last fetched for, None if there is none."""
+        with self._lock:
+            row = self._db.execute('select run from partition_runs where report=? and month=?',
+                                   (report, '%04d-%02d' % (year, month))).fetchone()
+        return row[0] if row else None
+
+    def setPartitionRun(self, report, year, month, run):
+        """Records the ga_queue run a partition is being fetched for."""
+        with self._lock, self._db:
+            self._db.execute('insert or replace into partition_runs values (?, ?, ?)',
+                             (report, '%04d-%02d' % (year, month), run))
+
+    def partitionWindows(self, report, year, month):
+        """Returns the date ranges of a finished partition, None if it isn't finished."""
+        with self._lock:
+            row = self._db.execute('select windows from partitions where report=? and month=?',
+                                   (report, '%04d-%02d' % (year, month))).fetchone()
+        return [tuple(w) for w in json.loads(row[0])] if row else None
+
+    def replaceHours(self, report, day, since, rowsByHour):
+        """Stores the rows of today's hours from `since` on, see ga_intraday.
+
+        Hours from `since` on that aren't in `rowsByHour`, and every hour
+        before `day`, are forgotten.
+
+        Args:
+            report: Report name
+            day: Today, 'YYYYMMDD'
+            since: First hour fetched, 'YYYYMMDDHH'
+            rowsByHour: {hour: rows}
+        """
+        with self._lock, self._db:
+            self._db.execute('delete from hours where report=? and (hour>=? or hour<?)',
+                             (report, since, day))
+            self._db.executemany('insert into hours values (?, ?, ?)',
+                                 [(report, hour, zlib.compress(dumps(rows)))
+                                  for hour, rows in rowsByHour.items()])
+
+    def hours(self, report, day):
+        """Returns {hour: rows} of the hours stored for a day, 'YYYYMMDD'."""
+        with self._lock:
+            return {hour: loads(zlib.decompress(blob)) for hour, blob in self._db.execute(
+                'select hour, rows from hours where report=? and substr(hour, 1, 8)=?',
+                (report, day))}
+
+    def markLoaded(self, report):
+        """Records that a report's table was loaded and indexed."""
+        with self._lock, self._db:
+            self._db.execute('insert or replace into loads values (?, ?)',
+                             (report, datetime.now().isoformat()))
+
+    def isLoaded(self, report):
+        """Returns True if a report's table was loaded by this run."""
+        with self._lock:
+            return self._db.execute('select 1 from loads where report=?',
+                                    (report,)).fetchone() is not None
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Analytics Reporting API V4 client pool
+#
+# `httplib2.Http` is not thread-safe, so a single service object can't be
+# shared between workers. The pool keeps one set of service account
+# credentials, refreshes the OAuth token before it expires, and hands each
+# thread its own authorized keep-alive connection and service object. The
+# discovery document is cached on disk so building a client doesn't cost a
+# round trip, and neither it nor googleapiclient is loaded until the first
+# service object is requested (the async client only needs tokens).
+# Service objects ask for gzip and decode responses with ga_transport.
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httplib2
+from oauth2client.service_account import ServiceAccountCredentials
+
+from ga_transport import USER_AGENT, loads
+
+DISCOVERY_URL = 'https://analyticsreporting.googleapis.com/$discovery/rest?version=v4'
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'google_analytics_extract',
+                               'analyticsreporting_v4.json')
+# Re-download the discovery document once a week
+DISCOVERY_MAX_AGE = 7 * 24 * 3600
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+HTTP_TIMEOUT = 300
+
+
+def loadDiscoveryDocument(path=DISCOVERY_CACHE, maxAge=DISCOVERY_MAX_AGE):
+    """Returns the Reporting API V4 discovery document, cached on disk.
+
+    Args:
+        path: Cache file location
+        maxAge: Seconds before the cached copy is re-downloaded
+    Returns:
+        The discovery document as a JSON string.
+    """
+    cached = os.path.exists(path)
+    if cached and time.time() - os.path.getmtime(path) < maxAge:
+        with open(path) as f:
+            return f.read()
+
+    resp, content = httplib2.Http(timeout=HTTP_TIMEOUT).request(DISCOVERY_URL)
+    if resp.status != 200:
+        if cached:
+            # A stale document is still better than failing the run
+            with open(path) as f:
+                return f.read()
+        raise RuntimeError('Unable to fetch discovery document: HTTP %s' % resp.status)
+
+    content = content.decode('utf-8')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        f.write(content)
+    os.replace(tmpPath, path)
+    return content
+
+
+def responseModel():
+    """Returns a googleapiclient JSON model that decodes with ga_transport.loads."""
+    from googleapiclient.model import JsonModel
+
+    class FastJsonModel(JsonModel):
+        def deserialize(self, content):
+            return loads(content)
+
+    return FastJsonModel()
+
+
+class ClientPool(object):
+    """Hands out one authorized Reporting API V4 service object per thread.
+
+    Args:
+        keyFile: Service account JSON key file
+        scopes: OAuth scopes to request
+        discoveryCache: Discovery document cache file
+        refreshMargin: Seconds before token expiry to refresh proactively
+    """
+
+    def __init__(self, keyFile, scopes, discoveryCache=DISCOVERY_CACHE,
+                 refreshMargin=TOKEN_REFRESH_MARGIN):
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(keyFile, scopes)
+        self.refreshMargin = refreshMargin
+        self.discoveryCache = discoveryCache
+        self._document = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._https = []
+
+    def refreshToken(self, force=False):
+        """Refreshes the shared access token if it is missing or about to expire."""
+        with self._lock:
+            expiry = self.credentials.token_expiry
+            if (force or self.credentials.access_token is None or expiry is None
+                    or expiry - datetime.utcnow() < timedelta(seconds=self.refreshMargin)):
+                self.credentials.refresh(httplib2.Http(timeout=HTTP_TIMEOUT))
+
+    def accessToken(self):
+        """Returns a valid OAuth access token for raw HTTP clients."""
+        self.refreshToken()
+        return self.credentials.access_token
+
+    def get(self):
+        """Returns the calling thread's service object.
+
+        Returns:
+            An authorized Analytics Reporting API V4 service object.
+        """
+        self.refreshToken()
+        analytics = getattr(self._local, 'analytics', None)
+        if analytics is None:
+            from googleapiclient.discovery import build_from_document
+            from googleapiclient.http import set_user_agent
+
+            http = set_user_agent(httplib2.Http(timeout=HTTP_TIMEOUT), USER_AGENT)
+            with self._lock:
+                if self._document is None:
+                    self._document = loadDiscoveryDocument(self.discoveryCache)
+                self._https.append(http)
+            analytics = build_from_document(self._document,
+                                            http=self.credentials.authorize(http),
+                                            model=responseModel())
+            self._local.analytics = analytics
+        return analytics
+
+    def close(self):
+        """Closes every connection handed out by the pool."""
+        with self._lock:
+            for http in self._https:
+                http.close()
+            self._https = []
+        self._local = threading.local()
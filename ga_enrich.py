@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Custom fields added to the report DataFrames
+#
+# Each custom field comes from a plugin in PLUGINS, and each report spec
+# lists the plugins it runs in 'plugins' (see ga_reports.ENRICH_PLUGINS). enrichment(spec) compiles a
+# spec's plugins once per run into one pass over each chunk:
+#
+# * Extract plugins pull regex groups out of a column. All the extracts of a
+#   spec that read the same column are fused into one anchored pattern of
+#   optional lookaheads, so each value is scanned once for every field.
+# * Lookup plugins map each distinct value of a column (a country to its
+#   support region) through a table kept for the whole run, so a value is
+#   only ever worked out once, whatever the report or chunk.
+# * Anything else is a function of the chunk.
+#
+# The time and rows of each step are kept per report for the end of run
+# summary.
+
+import re
+import threading
+import time
+
+import numpy as np
+
+import pandas as pd
+
+from ga_frames import monthDates
+from ga_reports import ARTICLE_ID, LOCALE_CODE, TICKET_ID
+
+# Support region for each country, first match wins
+SUPPORT_REGIONS = [
+    ('Australia', 'Australia'),
+    ('Brazil', 'Belize|Costa Rica|El Salvador|Guatemala|Honduras|Jamaica|Mexico|Nicaragua|Panama|Argentina|Bolivia|Brazil|Chile|Colombia|Ecuador|Paraguay|Peru|Uraguay|Uruguay|Venezuela|Cuba|Dominican Republic|Haiti'),
+    ('China', 'Cambodia|China|Hong Kong|Indonesia|Laos|Macau|Malaysia|Myanmar|New Zealand|Philippines|Pakistan|Singapore|South Korea|Sri Lanka|Taiwan|Thailand|Vietnam'),
+    ('Hungary', 'lbania|Algeria|Andorra|Angola|Austria|Bahrain|Belarus|Belgium|Benin|Bosnia and Herzegovina|Bosnia & Herzegovina|Botswana|Bulgaria|Burkina Faso|Burundi|Cameroon|Cape Verde|Central African Republic|Chad|Comoros|Croatia|Cyprus|Czechia|Czech Republic|Democratic Republic of the Congo|Denmark|Djibouti|Egypt|Equatorial Guinea|Eritrea|Estonia|Ethiopia|Faroe Islands|Finland|France|Gabon|Gambia|Georgia|Germany|Ghana|Gibraltar|Greece|Guernsey|Guinea|Hungary|Iceland|Iran|Iraq|Ireland|Israel|Italy|Ivory Coast|Jordan|Kazakhstan|Kenya|Kosovo|Kuwait|Latvia|Lebanon|Lesotho|Liberia|Libya|Liechtenstein|Lithuania|Luxembourg|Macedonia|Madagascar|Malawi|Mali|Malta|Mauritania|Mauritius|Moldova|Monaco|Montenegro|Morocco|Mozambique|Namibia|Netherlands|Niger|Nigeria|Norway|Poland|Qatar|Romania|Russia|Rwanda|San Marino|Saudi Arabia|Senegal|Serbia|Slovakia|Slovenia|Somalia|South Africa|Sudan|Swaziland|Sweden|Switzerland|Syria|Tanzania|Togo|Tunisia|Turkey|Uganda|Ukraine|United Arab Emirates|United Kingdom|Western Sahara|Yemen|Zambia|Zimbabwe'),
+    ('India', 'India|Bangladesh'),
+    ('Japan', 'Japan'),
+    ('Spain', 'Spain|Portugal'),
+    ('US', 'United States|Canada'),
+]
+DYNAMIC_SEGMENT = 'Dynamic Segment'
+
+
+class Extract(object):
+    """Plugin adding columns from the single regex group of each of its patterns.
+
+    A pattern is searched for as str.extract would; one starting with ^
+    matches at the start of the value only.
+
+    Args:
+        source: Column the patterns are matched against
+        columns: (new column, pattern) pairs
+    """
+
+    def __init__(self, source, columns):
+        self.source = source
+        self.columns = columns
+
+
+class Lookup(object):
+    """Plugin adding a column computed once per distinct value of another.
+
+    Args:
+        source: Column looked up
+        column: New column
+        function: Maps one value of `source` (NaN included) to the new column's value
+    """
+
+    def __init__(self, source, column, function):
+        self.source = source
+        self.column = column
+        self.function = function
+        self.table = {}
+        self._lock = threading.Lock()
+
+    def values(self, series):
+        """Returns the new column's values for a Series of the source column."""
+        codes, uniques = distinctValues(series)
+        with self._lock:
+            for value in uniques:
+                if value not in self.table:
+                    self.table[value] = self.function(value)
+            mapped = [self.table[value] for value in uniques]
+        # Missing values have code -1, which picks the function's value for NaN appended at the end
+        mapped.append(self.function(np.nan))
+        return np.array(mapped, dtype=object)[codes]
+
+
+def fusedPattern(patterns):
+    """Compiles one pattern matching every pattern's group at once.
+
+    Each pattern becomes an optional lookahead from the start of the value,
+    so group i of the result is the group of pattern i, None where it
+    doesn't match.
+    """
+    parts = []
+    for pattern in patterns:
+        body = pattern[1:] if pattern.startswith('^') else '(?s:.*?)' + pattern
+        parts.append('(?:(?=%s))?' % body)
+    regex = re.compile('^' + ''.join(parts))
+    if regex.groups != len(patterns):
+        raise ValueError('Extract patterns need exactly one group each: %r' % (patterns,))
+    return regex
+
+
+def distinctValues(series):
+    """Returns (codes, uniques) of a Series, code -1 for missing values."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    return pd.factorize(series)
+
+
+def extractColumns(series, regex):
+    """Returns one object array per group of `regex`, NaN where a group didn't match.
+
+    Each distinct value is matched once and spread out by its code.
+    """
+    codes, uniques = distinctValues(series)
+    match = regex.match
+    empty = (np.nan,) * regex.groups
+    rows = [match(v).groups(np.nan) if isinstance(v, str) else empty for v in uniques]
+    rows.append(empty)
+    groups = np.empty((len(rows), regex.groups), dtype=object)
+    groups[:] = rows
+    return [groups[codes, i] for i in range(regex.groups)]
+
+
+def clearDynamicSegment(df):
+    # N/A User role
+    df['UserRole'] = df['UserRole'].where(df['UserRole'] != DYNAMIC_SEGMENT)
+
+
+def addDate(df):
+    df['Date'] = monthDates(df['MonthofYear'])
+
+
+regionPatterns = None
+
+def supportRegionOf(country):
+    """Returns the support region of one country, 'other' when nothing matches."""
+    global regionPatterns
+    if regionPatterns is None:
+        regionPatterns = [(region, re.compile(pattern)) for region, pattern in SUPPORT_REGIONS]
+    if not isinstance(country, str):
+        return 'other'
+    for region, pattern in regionPatterns:
+        if pattern.search(country):
+            return region
+    return 'other'
+
+
+def supportRegion(country):
+    """Maps a Country column to support regions, 'other' when nothing matches."""
+    return PLUGINS['supportRegion'].values(country)
+
+
+PLUGINS = {
+    'clearDynamicSegment': clearDynamicSegment,
+    'articleIds': Extract('Page', [('ArticleId', ARTICLE_ID), ('LocaleCode', LOCALE_CODE)]),
+    'exitPageIds': Extract('ExitPage', [('ArticleId_ExitPage', ARTICLE_ID),
+                                        ('LocaleCode_ExitPage', LOCALE_CODE)]),
+    'ticketId': Extract('PreviousPagePath', [('TicketId', TICKET_ID)]),
+    'date': addDate,
+    'supportRegion': Lookup('Country', 'SupportRegion', supportRegionOf),
+}
+
+
+class Enrichment(object):
+    """A spec's plugins compiled into steps run over each chunk, see enrichment().
+
+    Calling it adds the custom fields to a chunk in place. `costs` holds
+    [seconds, rows] per step.
+
+    Args:
+        plugins: Plugin names, in the order their columns are added
+    """
+
+    def __init__(self, plugins):
+        self.steps = []
+        extracts = {}
+        for name in plugins:
+            plugin = PLUGINS[name]
+            if isinstance(plugin, Extract):
+                if plugin.source not in extracts:
+                    extracts[plugin.source] = ([], [])
+                    self.steps.append([None, plugin.source, extracts[plugin.source]])
+                extracts[plugin.source][0].append(name)
+                extracts[plugin.source][1].extend(plugin.columns)
+            else:
+                self.steps.append([name, None, plugin])
+        for step in self.steps:
+            if step[0] is None:
+                names, columns = step[2]
+                step[0] = '+'.join(names)
+                step[2] = ([column for column, pattern in columns],
+                           fusedPattern([pattern for column, pattern in columns]))
+        self.costs = {step[0]: [0.0, 0] for step in self.steps}
+        self._lock = threading.Lock()
+
+    def __call__(self, df):
+        for name, source, step in self.steps:
+            start = time.perf_counter()
+            if source is not None:
+                columns, regex = step
+                for column, values in zip(columns, extractColumns(df[source], regex)):
+                    df[column] = values
+            elif isinstance(step, Lookup):
+                df[step.column] = step.values(df[step.source])
+            else:
+                step(df)
+            with self._lock:
+                self.costs[name][0] += time.perf_counter() - start
+                self.costs[name][1] += len(df)
+
+    def summary(self):
+        """Returns 'step: seconds (rows)' for each step."""
+        return ', '.join('%s %.2fs (%d rows)' % (name, seconds, rows)
+                         for name, (seconds, rows) in self.costs.items())
+
+
+enrichments = {}
+enrichmentsLock = threading.Lock()
+
+def enrichment(spec):
+    """Returns the run's compiled Enrichment for a report spec."""
+    with enrichmentsLock:
+        if spec['name'] not in enrichments:
+            enrichments[spec['name']] = Enrichment(spec['plugins'])
+        return enrichments[spec['name']]
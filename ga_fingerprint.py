@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Change detection for (report, month) partitions
+#
+# Closed months rarely change in GA, so rewriting them on every run only
+# costs database I/O and binlog volume. Each partition gets a fingerprint of
+# its rows as they come back from the API: a sum of per-row hashes, so the
+# order pages and date ranges arrived in doesn't matter, plus the row count
+# and metric totals. The fingerprints of the partitions in a table are kept
+# next to it in the FINGERPRINT_TABLE metadata table, written in the same
+# transaction as the rows where possible, and the loader only rewrites the
+# months whose fingerprint differs from the last load.
+
+import hashlib
+from datetime import datetime
+
+FINGERPRINT_TABLE = 'ga_partitions'
+
+SCHEMA = '''
+create table if not exists %s (
+    report varchar(64) not null, month char(7) not null, fingerprint char(40) not null,
+    row_count integer not null, loaded varchar(32) not null,
+    primary key (report, month))
+''' % FINGERPRINT_TABLE
+
+
+def partitionFingerprint(spec, rows):
+    """Returns an order-independent fingerprint of a partition's rows.
+
+    The report's metrics and dimensions are part of the fingerprint, so a
+    changed spec reloads every month.
+
+    Args:
+        spec: Report spec from ga_reports.REPORTS
+        rows: ga_rows (dimensions, values) rows
+    Returns:
+        A 40 character hex digest.
+    """
+    rowSum = 0
+    totals = [0.0] * len(spec['metrics'])
+    for dimensions, values in rows:
+        key = '\x1f'.join(dimensions) + '\x1e' + '\x1f'.join(values)
+        rowSum += int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(),
+                                 'little')
+        for i, value in enumerate(values):
+            totals[i] += float(value)
+
+    digest = hashlib.sha1()
+    for part in (spec['metrics'], spec['dimensions'], [len(rows), rowSum % 2 ** 64], totals):
+        digest.update(repr(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def monthKey(year, month):
+    return '%04d-%02d' % (year, month)
+
+
+def loadedFingerprints(connection, report):
+    """Returns (fingerprint, row count) of a report's loaded partitions keyed by (year, month)."""
+    from sqlalchemy import text
+
+    connection.execute(SCHEMA)
+    result = connection.execute(
+        text('select month, fingerprint, row_count from %s where report = :report'
+             % FINGERPRINT_TABLE),
+        report=report)
+    return {(int(month[:4]), int(month[5:])): (fingerprint, count)
+            for month, fingerprint, count in result}
+
+
+def forgetFingerprints(connection, report, months=None):
+    """Deletes the fingerprints of some months of a report, or all of them."""
+    from sqlalchemy import text
+
+    connection.execute(SCHEMA)
+    if months is None:
+        connection.execute(text('delete from %s where report = :report' % FINGERPRINT_TABLE),
+                           report=report)
+        return
+    for year, month in months:
+        connection.execute(
+            text('delete from %s where report = :report and month = :month' % FINGERPRINT_TABLE),
+            report=report, month=monthKey(year, month))
+
+
+def saveFingerprints(connection, report, fingerprints):
+    """Records the fingerprints of freshly loaded partitions.
+
+    Args:
+        connection: SQLAlchemy connection
+        report: Report name
+        fingerprints: Dict of (fingerprint, row count) keyed by (year, month)
+    """
+    from sqlalchemy import text
+
+    forgetFingerprints(connection, report, list(fingerprints))
+    loaded = datetime.now().isoformat()
+    if fingerprints:
+        connection.execute(
+            text('insert into %s (report, month, fingerprint, row_count, loaded) '
+                 'values (:report, :month, :fingerprint, :row_count, :loaded)' % FINGERPRINT_TABLE),
+            [{'report': report, 'month': monthKey(*ym), 'fingerprint': fingerprint,
+              'row_count': count, 'loaded': loaded}
+             for ym, (fingerprint, count) in sorted(fingerprints.items())])
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Building report DataFrames
+#
+# Rows are converted a fixed-size chunk at a time by chunkFrame, which
+# ga_spill.FrameAccumulator calls as each month of a report arrives, so a
+# month's response dicts are freed as soon as they have been converted.
+# buildFrame does the same for a list of rows already held in full (the
+# benchmarks use it), taking chunks off its end. Low-cardinality dimensions
+# and page titles become categoricals over the run's ga_vocab vocabulary,
+# integer dimensions and metrics get the smallest integer dtype that holds
+# them, and only paths stay object columns.
+#
+# Year and Date come from the integer yyyymm MonthofYear with integer
+# arithmetic rather than by parsing each row's string again, so ga:year
+# doesn't need to be requested.
+
+import os
+
+import numpy as np
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from ga_reports import (COLUMN_NAMES, INTEGER_DIMENSIONS, SEGMENT_COLUMN, VIEW_COLUMN,
+                        YEAR_COLUMN)
+from ga_vocab import VOCABULARY_DIMENSIONS, vocabulary
+
+CHUNK_ROWS = 50000
+# Process size, in MB, past which building a report's frame logs a warning
+MEMORY_BUDGET_MB = 4096
+
+
+def rssBytes():
+    """Returns the resident set size of the process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # Only the peak is available here; ru_maxrss is in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def downcastIntegers(values):
+    """Parses GA integer strings into the smallest integer dtype that holds them.
+
+    Values that don't parse become NaN (and the column float), as with
+    pd.to_numeric(errors='coerce').
+    """
+    parsed = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+    if parsed.dtype.kind == 'f':
+        return parsed
+    if len(parsed) == 0 or parsed.min() >= 0:
+        return pd.to_numeric(parsed, downcast='unsigned')
+    return pd.to_numeric(parsed, downcast='integer')
+
+
+def monthYears(monthOfYear):
+    """Returns the year of each yyyymm integer, as int16 unless some are missing."""
+    years = monthOfYear // 100
+    return years.astype('int16') if years.dtype.kind in 'iu' else years
+
+
+def monthDates(monthOfYear):
+    """Returns the first day of each yyyymm integer as datetime64, NaT where missing.
+
+    A partition only holds a handful of months, so dates are computed for
+    the distinct values and spread back out by position.
+
+    Args:
+        monthOfYear: Series of yyyymm integers (float when some are missing)
+    Returns:
+        A datetime64[ns] Series with the same index.
+    """
+    codes, uniques = pd.factorize(monthOfYear)
+    ym = np.asarray(uniques, dtype='int64')
+    dates = ((ym // 100 - 1970) * 12 + ym % 100 - 1).astype('datetime64[M]')
+    # Missing values have code -1, which picks the NaT appended at the end
+    dates = np.append(dates.astype('datetime64[ns]'), np.datetime64('NaT', 'ns'))
+    return pd.Series(dates[codes], index=monthOfYear.index)
+
+
+def chunkFrame(spec, rows):
+    """Converts a list of (dimensions, values) rows into a compact DataFrame.
+
+    Args:
+        spec: Report spec from ga_reports.REPORTS
+        rows: ga_rows (dimensions, values) rows
+    Returns:
+        A DataFrame with one column per named dimension and metric.
+    """
+    data = {}
+    if spec.get('viewColumn'):
+        # ga_targets.tagRows appended the view and segment ids after the requested dimensions
+        view = len(spec['dimensions'])
+        for i, column in enumerate((VIEW_COLUMN, SEGMENT_COLUMN)):
+            data[column] = pd.Series(vocabulary.categorical(column,
+                                                            [v[0][view + i] for v in rows]))
+    for i, dimension in enumerate(spec['dimensions']):
+        name = COLUMN_NAMES.get(dimension)
+        if name is None:
+            continue
+        values = [v[0][i] for v in rows]
+        if dimension in INTEGER_DIMENSIONS:
+            data[name] = downcastIntegers(values)
+            if dimension == 'ga:yearMonth' and spec.get('yearColumn'):
+                data[YEAR_COLUMN] = monthYears(data[name])
+                # Year goes before MonthofYear, where ga:year used to be
+                data[name] = data.pop(name)
+        elif dimension in VOCABULARY_DIMENSIONS:
+            data[name] = pd.Series(vocabulary.categorical(name, values))
+        else:
+            data[name] = pd.Series(values, dtype=object)
+    for i, metric in enumerate(spec['metrics']):
+        data[COLUMN_NAMES[metric]] = downcastIntegers([v[1][i] for v in rows])
+    return pd.DataFrame(data)
+
+
+def concatFrames(chunks):
+    """Concatenates chunk frames, keeping categorical columns categorical.
+
+    Vocabulary-encoded chunks already agree on their codes: each gets the
+    latest chunk's categories, which only adds unused ones.
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            dtypes = [c[col].dtype for c in chunks]
+            widest = max(dtypes, key=lambda d: len(d.categories))
+            if all(widest.categories[:len(d.categories)].equals(d.categories) for d in dtypes):
+                for c in chunks:
+                    c[col] = pd.Categorical.from_codes(c[col].cat.codes, dtype=widest)
+                continue
+            categories = union_categoricals([c[col] for c in chunks]).categories
+            for c in chunks:
+                c[col] = c[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def buildFrame(spec, rows, chunkRows=CHUNK_ROWS, validator=None):
+    """Builds a report's DataFrame from its accumulated rows.
+
+    `rows` is emptied as it is consumed.
+
+    Args:
+        spec: Report spec from ga_reports.REPORTS
+        rows: List of ga_rows (dimensions, values) rows
+        chunkRows: Rows converted per chunk
+        validator: ga_validate.PartitionValidator handed each chunk
+    Returns:
+        (DataFrame, stats) where stats has the row count, frame size and the
+        peak process size seen while building, in MB.
+    """
+    total = len(rows)
+    peak = rssBytes()
+    chunks = []
+    while rows:
+        chunk = rows[-chunkRows:]
+        del rows[-chunkRows:]
+        chunks.append(chunkFrame(spec, chunk))
+        del chunk
+        if validator is not None:
+            validator.addChunk(chunks[-1])
+        peak = max(peak, rssBytes())
+    chunks.reverse()
+
+    frame = concatFrames(chunks) if chunks else chunkFrame(spec, [])
+    del chunks
+    peak = max(peak, rssBytes())
+
+    mb = 1024.0 * 1024.0
+    stats = {
+        'rows': total,
+        'frame_mb': round(frame.memory_usage(deep=True).sum() / mb, 1),
+        'peak_rss_mb': round(peak / mb, 1),
+    }
+    stats['over_budget'] = stats['peak_rss_mb'] > MEMORY_BUDGET_MB
+    return frame, stats
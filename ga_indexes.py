@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Indexes for the dashboard queries
+#
+# Besides the indexes in its spec, each table gets one index per dashboard
+# query in its spec's 'queries' (ga_reports.DASHBOARD_QUERIES). An index
+# starts with the query's equality columns, then its range column, then its
+# group by columns, and ends with every metric: MonthofYear ranges are read
+# from one slice of the index and the sums never touch the table rows.
+# An index that is a prefix of another one is left out.
+#
+# ga_sinks declares the text columns of these indexes VARCHAR instead of
+# TEXT so MySQL can index them whole. Tables only get the new layout when
+# they are rebuilt (backfill or load); bench_queries.py times the queries
+# against both layouts.
+
+from ga_reports import COLUMN_NAMES, REPORTS
+
+
+def metricColumns(spec):
+    """Returns the metric column names of a report spec."""
+    return [COLUMN_NAMES[m] for m in spec['metrics']]
+
+
+def queryColumns(spec, query):
+    """Returns the columns of a query's index, in index order."""
+    columns = []
+    for column in (query['equal'] + ([query['range']] if query.get('range') else [])
+                   + query['group'] + metricColumns(spec)):
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+def queryIndexes(report, spec=None):
+    """Returns the (name, columns, unique) indexes of a report's dashboard queries.
+
+    Args:
+        report: Report name in REPORTS
+        spec: The report's spec, REPORTS[report] by default
+    Returns:
+        One index per query, named GA_INDEX_<report>_<query>, except those
+        whose columns start another index of the table.
+    """
+    spec = spec or REPORTS[report]
+    indexes = []
+    for query in spec['queries']:
+        columns = queryColumns(spec, query)
+        if all(other != columns for name, other, unique in indexes):
+            indexes.append(('GA_INDEX_%s_%s' % (report, query['name']), columns, False))
+    tableColumns = [columns for name, columns, unique in spec['indexes'] + indexes]
+    return [(name, columns, unique) for name, columns, unique in indexes
+            if not any(len(other) > len(columns) and other[:len(columns)] == columns
+                       for other in tableColumns)]
+
+
+def tableIndexes(report, spec=None):
+    """Returns every (name, columns, unique) index of a report's table."""
+    spec = spec or REPORTS[report]
+    return spec['indexes'] + queryIndexes(report, spec)
+
+
+def querySql(table, spec, query, quote):
+    """Returns a dashboard query's SQL, with :named parameters.
+
+    Equality columns are bound by their name, the range by <column>_from
+    and <column>_to.
+
+    Args:
+        table: Table name
+        spec: Report spec of the table
+        query: One of the spec's 'queries'
+        quote: Identifier quoting function of the database
+    """
+    where = ['%s = :%s' % (quote(c), c) for c in query['equal']]
+    if query.get('range'):
+        where.append('%s between :%s_from and :%s_to' % (
+            quote(query['range']), query['range'], query['range']))
+    group = ', '.join(quote(c) for c in query['group'])
+    sums = ', '.join('sum(%s) as %s' % (quote(c), quote(c)) for c in metricColumns(spec))
+    return 'select %s, %s from %s where %s group by %s' % (
+        group, sums, quote(table), ' and '.join(where), group)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Today's hours of the open month
+#
+# With INTRADAY set in google_analytics.py, backfill and refresh fetch the
+# open month up to yesterday and today belongs to the `intraday` command,
+# cheap enough to run every 15 minutes. Each run asks GA for the last
+# INTRADAY_HOURS hours of today only, with ga:dateHour in place of
+# ga:yearMonth, and stores each hour's rows in the checkpoint, replacing
+# what earlier runs stored for those hours: GA keeps revising the last few
+# hours. Any hour of today that was never stored (the first run of the day)
+# is fetched too.
+#
+# The open month's rows are then the partition up to yesterday, read from
+# the checkpoint, plus every stored hour of today, merged by ga_aggregate as
+# if each hour were one more date range: additive metrics are summed and
+# non-additive ones keep their largest value. Only the open month is
+# rewritten, and only when its fingerprint changed.
+#
+# That rewrite is the whole open month, not just today's rows: a table row
+# is a month total that today's hours were merged into, and the sinks have
+# no per-row key to update in place, so replaceMonths deletes the month and
+# inserts it again. Its cost grows with the month, largest on its last day.
+# Run intraday every 15 minutes (INTRADAY_HOURS covers the hours GA revises
+# in between), and never more often than rewriting a full month takes.
+#
+# Hours are in the host's local time, which has to match the view's time
+# zone.
+
+import sys
+from datetime import timedelta
+
+# Hours of today fetched again by every intraday run
+INTRADAY_HOURS = 3
+HOUR_DIMENSION = 'ga:dateHour'
+MONTH_DIMENSION = 'ga:yearMonth'
+
+
+def hourKey(moment):
+    """Returns a datetime's hour as a ga:dateHour value, 'YYYYMMDDHH'."""
+    return moment.strftime('%Y%m%d%H')
+
+
+def hourRange(first, last):
+    """Returns the 'YYYYMMDDHH' hours from datetime `first` up to and including `last`."""
+    hours = []
+    moment = first.replace(minute=0, second=0, microsecond=0)
+    while moment <= last:
+        hours.append(hourKey(moment))
+        moment += timedelta(hours=1)
+    return hours
+
+
+def firstHour(now, hours, stored):
+    """Returns the first hour an intraday run fetches.
+
+    Args:
+        now: The current time
+        hours: Hours of today to fetch again
+        stored: Hours of today already stored
+    Returns:
+        The 'YYYYMMDDHH' hour `hours` hours back, or midnight if an earlier
+        hour of today is missing from `stored`.
+    """
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    since = max(midnight, now - timedelta(hours=max(hours, 1) - 1))
+    if any(hour not in stored for hour in hourRange(midnight, since - timedelta(hours=1))):
+        return hourKey(midnight)
+    return hourKey(since)
+
+
+def hourlySpec(spec, since):
+    """Returns the spec today's hours from `since` on are fetched with.
+
+    Args:
+        spec: Report spec (or ga_merge merged spec) of the open month
+        since: First hour to fetch, 'YYYYMMDDHH'
+    Returns:
+        A copy of `spec` with ga:dateHour instead of ga:yearMonth and a
+        filter on the hour.
+    """
+    return dict(spec, name=spec['name'] + '#hourly',
+                dimensions=[HOUR_DIMENSION if d == MONTH_DIMENSION else d
+                            for d in spec['dimensions']],
+                dimensionFilters=spec['dimensionFilters'] + [
+                    [(HOUR_DIMENSION, 'NUMERIC_GREATER_THAN', str(int(since) - 1))]])
+
+
+def splitHours(spec, rows, hours):
+    """Splits hourly rows by hour, putting the month back in place of the hour.
+
+    Args:
+        spec: Report spec the hourly spec was made from
+        rows: ga_rows rows fetched with hourlySpec(spec)
+        hours: The hours fetched; hours without rows get an empty list
+    Returns:
+        {hour: rows with spec's dimensions}, for `hours` only.
+    """
+    position = spec['dimensions'].index(MONTH_DIMENSION)
+    byHour = {hour: [] for hour in hours}
+    for dimensions, values in rows:
+        hour = dimensions[position]
+        if hour in byHour:
+            month = sys.intern(hour[:6])
+            byHour[hour].append((dimensions[:position] + (month,) + dimensions[position + 1:],
+                                 values))
+    return byHour
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Merging compatible reports into one request
+#
+# Several reports ask for the same dimensions, segment and filters and only
+# differ in their metrics (ticketuserdata, selfservicescoredata and
+# ticketformsession, for example). Those are fetched with a single wider
+# request, up to GA's limit of 10 metrics and 9 dimensions, and each
+# report's rows are projected back out of the merged rows, so the rest of
+# the pipeline still sees one report at a time.
+#
+# Dimensions determined by another requested dimension (ga:year by
+# ga:yearMonth) don't change a report's grain, so they don't stop a merge.
+# Reports are only merged with reports that filter zero rows the same way.
+# A merged request of filtered reports only filters out rows where all of
+# its metrics are zero, so projection drops the rows where all of a
+# report's own metrics are zero, which are the rows GA would have left out
+# of that report's own request. Without the filter (no 'metricFilters', or
+# SERVER_FILTERS off) every row is kept, as the report's own request would.
+
+import functools
+
+import ga_reports
+from ga_reports import REPORTS, anyMetric
+
+MAX_METRICS = 10
+MAX_DIMENSIONS = 9
+# Dimensions whose value follows from another dimension
+DERIVED_DIMENSIONS = {'ga:year': 'ga:yearMonth'}
+# Set to False to request every report separately
+MERGE_REPORTS = True
+
+
+def mergeKey(spec):
+    """Returns what two specs must share to be fetched together, None if the spec can't be merged."""
+    if spec['metricFilters'] not in ([], [anyMetric(spec['metrics'])]):
+        return None
+    dimensions = set(spec['dimensions'])
+    grain = frozenset(d for d in dimensions if DERIVED_DIMENSIONS.get(d) not in dimensions)
+    return (spec['segment'], grain, repr(spec['dimensionFilters']), bool(spec['metricFilters']))
+
+
+def union(lists):
+    result = []
+    for items in lists:
+        result.extend(i for i in items if i not in result)
+    return result
+
+
+def planMerges(reports):
+    """Groups reports that can be fetched with one request.
+
+    Args:
+        reports: Report names in REPORTS
+    Returns:
+        A dict mapping every report to its group, a tuple of report names in
+        REPORTS order. Reports that can't be merged are a group of one.
+    """
+    groups = []
+    for name in [r for r in REPORTS if r in reports]:
+        spec = REPORTS[name]
+        key = mergeKey(spec) if MERGE_REPORTS else None
+        for group in groups:
+            if key is None or group['key'] != key:
+                continue
+            specs = [REPORTS[r] for r in group['reports']] + [spec]
+            if (len(union(s['metrics'] for s in specs)) <= MAX_METRICS
+                    and len(union(s['dimensions'] for s in specs)) <= MAX_DIMENSIONS):
+                group['reports'].append(name)
+                break
+        else:
+            groups.append({'key': key, 'reports': [name]})
+    return {r: tuple(g['reports']) for g in groups for r in g['reports']}
+
+
+def activeReports(group, year, month):
+    """Returns the reports of a group that have data for a month."""
+    first = '%04d-%02d' % (year, month)
+    return tuple(r for r in group if REPORTS[r]['start'][:7] <= first)
+
+
+@functools.lru_cache(maxsize=None)
+def mergedSpec(reports):
+    """Returns the spec of the single request that fetches every report in `reports`."""
+    specs = [REPORTS[r] for r in reports]
+    metrics = union(s['metrics'] for s in specs)
+    return {
+        'name': '+'.join(reports),
+        'reports': reports,
+        'metrics': metrics,
+        'dimensions': union(s['dimensions'] for s in specs),
+        'start': min(s['start'] for s in specs),
+        'segment': specs[0]['segment'],
+        'dimensionFilters': specs[0]['dimensionFilters'],
+        'metricFilters': [anyMetric(metrics)] if any(s['metricFilters'] for s in specs) else [],
+    }
+
+
+def projectRows(merged, spec, rows):
+    """Takes one report's rows out of a merged request's rows.
+
+    Args:
+        merged: Spec from mergedSpec()
+        spec: Report spec from REPORTS, one of the merged reports
+        rows: Rows of the merged request
+    Returns:
+        Rows shaped as if `spec` had been requested on its own.
+    """
+    dimensions = [merged['dimensions'].index(d) for d in spec['dimensions']]
+    metrics = [merged['metrics'].index(m) for m in spec['metrics']]
+    # Only a request sent with the anyMetric filter left out zero rows
+    dropZeros = bool(ga_reports.SERVER_FILTERS and merged['metricFilters'])
+    projected = []
+    for rowDimensions, values in rows:
+        picked = tuple([values[i] for i in metrics])
+        if dropZeros and not any(float(v) for v in picked):
+            continue
+        projected.append((tuple([rowDimensions[i] for i in dimensions]), picked))
+    return projected
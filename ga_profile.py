@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Per-stage profiling of a run
+#
+# `--profile DIR` wraps each stage of each report (fetch, fingerprint,
+# convert, enrich, load, validate) in a profiler and writes, when the run
+# ends:
+#
+# * <report>.<stage>.pstats: cProfile stats, for pstats, snakeviz or
+#   gprof2dot
+# * <report>.<stage>.folded: with `--profiler sample`, stacks sampled every
+#   SAMPLE_INTERVAL seconds in the collapsed format py-spy writes with
+#   `--format raw`, for flamegraph.pl, inferno or speedscope
+# * summary.txt: wall time per stage and the functions where the most time
+#   went, also logged at the end of the run
+#
+# cProfile only sees the thread that enabled it, so each stage is profiled
+# on the thread that runs it: a fetch on a worker thread gets its own
+# profile, merged into the report's fetch stats. On Python 3.12+, where only
+# one cProfile can run at a time, concurrent stages are only timed. A stage
+# started inside another (custom fields added while a spilled frame is
+# loaded) is timed but its calls are counted in the outer stage. The
+# sampling profiler sees every thread and costs less, at the price of exact
+# call counts.
+#
+# Without --profile, profiled() is a no-op.
+
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+SAMPLE_INTERVAL = 0.005
+# Functions listed in the summary
+TOP_FUNCTIONS = 20
+
+NOT_PROFILED = contextlib.nullcontext()
+
+
+def frameLabel(code, line):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), line)
+
+
+class Profiler(object):
+    """Profiles named stages of each report.
+
+    Args:
+        directory: Where profiles and summary.txt are written
+        mode: 'cprofile' or 'sample'
+        interval: Seconds between samples in 'sample' mode
+    """
+
+    def __init__(self, directory, mode='cprofile', interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.wall = Counter()
+        self.stats = {}
+        self.samples = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Innermost stage of each thread, for the sampler
+        self._active = {}
+        self._stop = threading.Event()
+        self._sampler = None
+        if mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, report):
+        """Profiles the enclosed block as `report`'s `name` stage."""
+        import cProfile
+        import pstats
+
+        key = (report, name)
+        stack = self._local.__dict__.setdefault('stack', [])
+        profile = None
+        if self.mode == 'cprofile' and not stack:
+            profile = cProfile.Profile()
+        stack.append(key)
+        self._active[threading.get_ident()] = key
+        start = time.perf_counter()
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one cProfile per process: another thread's stage has it
+                profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                self._active[threading.get_ident()] = stack[-1]
+            else:
+                self._active.pop(threading.get_ident(), None)
+            with self._lock:
+                self.wall[key] += elapsed
+                if profile is not None:
+                    if key in self.stats:
+                        self.stats[key].add(profile)
+                    else:
+                        self.stats[key] = pstats.Stats(profile)
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread, key in list(self._active.items()):
+                frame = frames.get(thread)
+                if frame is None or thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frameLabel(frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                self.samples[key][';'.join(reversed(stack))] += 1
+
+    def hotspots(self):
+        """Returns [(seconds or samples, label)] of the functions with the most self time."""
+        total = Counter()
+        if self.mode == 'sample':
+            for counts in self.samples.values():
+                for stack, count in counts.items():
+                    total[stack.rsplit(';', 1)[-1]] += count
+        else:
+            for stats in self.stats.values():
+                for (filename, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+                    total['%s (%s:%d)' % (function, os.path.basename(filename), line)] += tt
+        return [(value, label) for label, value in total.most_common(TOP_FUNCTIONS)]
+
+    def write(self):
+        """Stops sampling, writes every stage's profile and summary.txt.
+
+        Returns:
+            The summary lines.
+        """
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        os.makedirs(self.directory, exist_ok=True)
+        for (report, name), stats in self.stats.items():
+            stats.dump_stats(os.path.join(self.directory, '%s.%s.pstats' % (report, name)))
+        for (report, name), counts in self.samples.items():
+            with open(os.path.join(self.directory, '%s.%s.folded' % (report, name)), 'w') as f:
+                for stack, count in sorted(counts.items()):
+                    f.write('%s %d\n' % (stack, count))
+
+        lines = ['%-28s %-12s %10s' % ('report', 'stage', 'seconds')]
+        for (report, name), seconds in self.wall.most_common():
+            lines.append('%-28s %-12s %10.2f' % (report, name, seconds))
+        unit = 'samples' if self.mode == 'sample' else 'self seconds'
+        lines.append('')
+        lines.append('top functions by %s:' % unit)
+        for value, label in self.hotspots():
+            lines.append('%10s  %s' % (value if self.mode == 'sample' else '%.2f' % value, label))
+        with open(os.path.join(self.directory, 'summary.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return lines
+
+
+profiler = None
+
+def start(directory, mode='cprofile'):
+    """Turns profiling on for the rest of the run."""
+    global profiler
+    profiler = Profiler(directory, mode)
+
+
+def profiled(name, report):
+    """Returns a context manager profiling a stage, a no-op unless start() was called."""
+    if profiler is None:
+        return NOT_PROFILED
+    return profiler.stage(name, report)
+
+
+def finish():
+    """Writes the profiles and returns the summary lines, [] when profiling is off."""
+    global profiler
+    if profiler is None:
+        return []
+    lines = profiler.write()
+    profiler = None
+    return lines
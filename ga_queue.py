@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Work queue for extracting on several hosts
+#
+# A coordinator (backfill, refresh, extract or load with --queue) enqueues
+# one work item per (view, report, month) and stateless workers
+# (`google_analytics.py worker --queue URL`) on any number of hosts lease
+# items, fetch them with their own service account and checkpoint, and land
+# the partition's rows back in the queue. The coordinator works through the
+# queue with its own -j threads too, then loads the landed rows as if it had
+# fetched them itself.
+#
+# A lease runs out after LEASE_SECONDS unless its worker keeps renewing it,
+# so the items of a worker that crashed or lost its host go back to the
+# queue. A worker whose lease ran out can't land rows any more: completing
+# an item takes the token of the current lease. An item that fails
+# MAX_ATTEMPTS times is marked failed and the coordinator stops.
+#
+# Queues:
+#
+# * postgresql://... or mysql+pymysql://...: the WORK_TABLE table of a
+#   database server every host can reach. Lease times are taken from the
+#   server's clock, so the hosts' clocks don't have to agree. Landed rows
+#   are stored in the table too: on MySQL, max_allowed_packet has to hold a
+#   month's compressed rows.
+# * sqlite:///path/queue.db: a SQLite file, for workers on one host only.
+#   SQLite's locking isn't reliable over NFS or SMB, so two hosts sharing
+#   the file could lease the same item.
+# * memory: an in-process queue, for trying things out on one host
+#
+# Another backend only needs the methods of MemoryQueue.
+
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from ga_quota import QuotaExhausted
+from ga_transport import dumps, loads
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_SECONDS = 600
+# Seconds between polls while every remaining item is leased by someone else
+POLL_SECONDS = 5
+# A worker with nothing to do waits this long for a coordinator to enqueue more
+IDLE_SECONDS = 60
+MAX_ATTEMPTS = 3
+
+# Table of the database server queue
+WORK_TABLE = 'ga_work'
+# Seconds since the epoch by the database server's clock
+SERVER_CLOCK = {
+    'postgresql': 'extract(epoch from clock_timestamp())',
+    'mysql': 'unix_timestamp(now(6))',
+    'mariadb': 'unix_timestamp(now(6))',
+    'sqlite': "(julianday('now') - 2440587.5) * 86400.0",
+}
+
+SCHEMA = '''
+create table if not exists work (
+    key text primary key, item text, status text, lease_token text, lease_until real,
+    worker text, attempts integer, error text, rows blob, updated text)
+'''
+
+
+def itemKey(item):
+    """Returns the queue key of a work item dict."""
+    return '%s|%s|%s|%04d-%02d' % (item['view'], item['segment'] or '', item['report'],
+                                   item['year'], item['month'])
+
+
+def newToken():
+    import uuid
+
+    return uuid.uuid4().hex
+
+
+def workerName():
+    import socket
+
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(), threading.get_ident())
+
+
+class MemoryQueue(object):
+    """In-process work queue with the same leases as SqliteQueue."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def enqueue(self, items):
+        """Adds work items; items already in the queue, in any state, are left alone."""
+        with self._lock:
+            for item in items:
+                self._items.setdefault(itemKey(item), {
+                    'item': item, 'status': PENDING, 'token': None, 'until': 0.0,
+                    'worker': None, 'attempts': 0, 'error': None, 'rows': None})
+
+    def discard(self, keys):
+        """Removes items so the next enqueue starts them over."""
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        """Leases the oldest pending or expired item.
+
+        Returns:
+            (key, item, token), or None when nothing can be leased right now.
+        """
+        now = time.time()
+        with self._lock:
+            for key, entry in self._items.items():
+                if entry['status'] == PENDING or (entry['status'] == LEASED
+                                                  and entry['until'] < now):
+                    entry.update(status=LEASED, token=newToken(), until=now + seconds,
+                                 worker=worker)
+                    return key, entry['item'], entry['token']
+        return None
+
+    def renew(self, key, token, seconds=LEASE_SECONDS):
+        """Extends a lease. Returns False if the lease was lost."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry['status'] != LEASED or entry['token'] != token:
+                return False
+            entry['until'] = time.time() + seconds
+            return True
+
+    def complete(self, key, token, rows):
+        """Lands an item's rows. Returns False if the lease was lost."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry['status'] != LEASED or entry['token'] != token:
+                return False
+            entry.update(status=DONE, token=None, rows=zlib.compress(dumps(rows)))
+            return True
+
+    def fail(self, key, token, error, retry=True):
+        """Gives an item back after a failed fetch, or marks it failed after MAX_ATTEMPTS."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry['status'] != LEASED or entry['token'] != token:
+                return
+            if retry:
+                entry['attempts'] += 1
+            entry.update(status=FAILED if entry['attempts'] >= MAX_ATTEMPTS else PENDING,
+                         token=None, error=error)
+
+    def status(self, keys=None):
+        """Returns {key: (status, error)} for some keys, or for every item."""
+        keys = None if keys is None else set(keys)
+        with self._lock:
+            return {k: (e['status'], e['error']) for k, e in self._items.items()
+                    if keys is None or k in keys}
+
+    def rows(self, key):
+        """Returns the landed rows of a finished item."""
+        with self._lock:
+            return loads(zlib.decompress(self._items[key]['rows']))
+
+
+class SqliteQueue(object):
+    """Work queue in a SQLite file shared by the workers of one host.
+
+    Each call opens its own connection, so the queue can be used from any
+    thread, and leases are taken in an immediate transaction so two workers
+    never get the same item.
+
+    Args:
+        path: Path of the queue database
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute('begin immediate')
+        return _Transaction(db)
+
+    def enqueue(self, items):
+        with self._connect() as db:
+            db.executemany(
+                'insert or ignore into work (key, item, status, attempts, updated) '
+                'values (?, ?, ?, 0, ?)',
+                [(itemKey(item), dumps(item).decode('utf-8'), PENDING,
+                  datetime.now().isoformat()) for item in items])
+
+    def discard(self, keys):
+        with self._connect() as db:
+            db.executemany('delete from work where key=?', [(k,) for k in keys])
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute(
+                'select key, item from work where status=? or (status=? and lease_until<?) '
+                'order by rowid limit 1', (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            token = newToken()
+            db.execute('update work set status=?, lease_token=?, lease_until=?, worker=?, '
+                       'updated=? where key=?',
+                       (LEASED, token, now + seconds, worker, datetime.now().isoformat(),
+                        row[0]))
+        return row[0], loads(row[1]), token
+
+    def renew(self, key, token, seconds=LEASE_SECONDS):
+        with self._connect() as db:
+            return db.execute(
+                'update work set lease_until=? where key=? and status=? and lease_token=?',
+                (time.time() + seconds, key, LEASED, token)).rowcount == 1
+
+    def complete(self, key, token, rows):
+        blob = zlib.compress(dumps(rows))
+        with self._connect() as db:
+            return db.execute(
+                'update work set status=?, lease_token=null, rows=?, updated=? '
+                'where key=? and status=? and lease_token=?',
+                (DONE, blob, datetime.now().isoformat(), key, LEASED, token)).rowcount == 1
+
+    def fail(self, key, token, error, retry=True):
+        with self._connect() as db:
+            db.execute(
+                'update work set attempts=attempts+?, '
+                'status=case when attempts+?>=? then ? else ? end, '
+                'lease_token=null, error=?, updated=? '
+                'where key=? and status=? and lease_token=?',
+                (int(retry), int(retry), MAX_ATTEMPTS, FAILED, PENDING, error,
+                 datetime.now().isoformat(), key, LEASED, token))
+
+    def status(self, keys=None):
+        keys = None if keys is None else set(keys)
+        with self._connect() as db:
+            rows = db.execute('select key, status, error from work').fetchall()
+        return {k: (s, e) for k, s, e in rows if keys is None or k in keys}
+
+    def rows(self, key):
+        with self._connect() as db:
+            blob, = db.execute('select rows from work where key=?', (key,)).fetchone()
+        return loads(zlib.decompress(blob))
+
+
+class SqlQueue(object):
+    """Work queue in a database server table shared by every host.
+
+    A lease is taken by an update that only matches while the item is
+    still free, so when two hosts pick the same item one update finds
+    nothing and that host moves on to the next item. Lease expiry is
+    computed and checked with the server's clock.
+
+    Args:
+        url: SQLAlchemy URL of a PostgreSQL or MySQL database
+    """
+
+    def __init__(self, url):
+        from sqlalchemy import (Column, Float, Integer, LargeBinary, MetaData, String, Table,
+                                Text, create_engine)
+        from sqlalchemy.dialects.mysql import LONGBLOB
+
+        self.engine = create_engine(url, pool_pre_ping=True)
+        self.clock = SERVER_CLOCK[self.engine.dialect.name]
+        metadata = MetaData()
+        Table(WORK_TABLE, metadata,
+              Column('id', Integer, primary_key=True, autoincrement=True),
+              Column('item_key', String(190), nullable=False, unique=True),
+              Column('item', Text), Column('status', String(16)),
+              Column('lease_token', String(32)), Column('lease_until', Float(53)),
+              Column('worker', String(190)), Column('attempts', Integer),
+              Column('error', Text),
+              Column('landed_rows', LargeBinary().with_variant(LONGBLOB(), 'mysql')),
+              Column('updated', String(32)))
+        metadata.create_all(self.engine)
+
+    def _execute(self, db, sql, params=None):
+        from sqlalchemy import text
+
+        return db.execute(text(sql % {'table': WORK_TABLE, 'clock': self.clock}), params or {})
+
+    def enqueue(self, items):
+        with self.engine.begin() as db:
+            queued = {key for key, in self._execute(db, 'select item_key from %(table)s')}
+            values = [{'key': itemKey(item), 'item': dumps(item).decode('utf-8'),
+                       'status': PENDING, 'updated': datetime.now().isoformat()}
+                      for item in items if itemKey(item) not in queued]
+            if values:
+                self._execute(db, 'insert into %(table)s (item_key, item, status, attempts, '
+                                  'updated) values (:key, :item, :status, 0, :updated)', values)
+
+    def discard(self, keys):
+        keys = list(keys)
+        if keys:
+            with self.engine.begin() as db:
+                self._execute(db, 'delete from %(table)s where item_key = :key',
+                              [{'key': k} for k in keys])
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        while True:
+            with self.engine.begin() as db:
+                now = float(self._execute(db, 'select %(clock)s').scalar())
+                free = {'pending': PENDING, 'leased': LEASED, 'now': now}
+                row = self._execute(
+                    db, 'select item_key, item from %(table)s where status = :pending or '
+                        '(status = :leased and lease_until < :now) order by id limit 1',
+                    free).fetchone()
+                if row is None:
+                    return None
+                token = newToken()
+                taken = self._execute(
+                    db, 'update %(table)s set status = :leased, lease_token = :token, '
+                        'lease_until = :until, worker = :worker, updated = :updated '
+                        'where item_key = :key and (status = :pending or '
+                        '(status = :leased and lease_until < :now))',
+                    dict(free, token=token, until=now + seconds, worker=worker,
+                         updated=datetime.now().isoformat(), key=row[0])).rowcount
+            if taken == 1:
+                return row[0], loads(row[1]), token
+
+    def renew(self, key, token, seconds=LEASE_SECONDS):
+        with self.engine.begin() as db:
+            return self._execute(
+                db, 'update %(table)s set lease_until = %(clock)s + :seconds '
+                    'where item_key = :key and status = :leased and lease_token = :token',
+                {'seconds': seconds, 'key': key, 'leased': LEASED, 'token': token}).rowcount == 1
+
+    def complete(self, key, token, rows):
+        blob = zlib.compress(dumps(rows))
+        with self.engine.begin() as db:
+            return self._execute(
+                db, 'update %(table)s set status = :done, lease_token = null, '
+                    'landed_rows = :rows, updated = :updated '
+                    'where item_key = :key and status = :leased and lease_token = :token',
+                {'done': DONE, 'rows': blob, 'updated': datetime.now().isoformat(), 'key': key,
+                 'leased': LEASED, 'token': token}).rowcount == 1
+
+    def fail(self, key, token, error, retry=True):
+        with self.engine.begin() as db:
+            self._execute(
+                db, 'update %(table)s set attempts = attempts + :retry, '
+                    'status = case when attempts + :retry >= :max then :failed else :pending end, '
+                    'lease_token = null, error = :error, updated = :updated '
+                    'where item_key = :key and status = :leased and lease_token = :token',
+                {'retry': int(retry), 'max': MAX_ATTEMPTS, 'failed': FAILED, 'pending': PENDING,
+                 'error': error, 'updated': datetime.now().isoformat(), 'key': key,
+                 'leased': LEASED, 'token': token})
+
+    def status(self, keys=None):
+        keys = None if keys is None else set(keys)
+        with self.engine.begin() as db:
+            rows = self._execute(db, 'select item_key, status, error from %(table)s').fetchall()
+        return {k: (s, e) for k, s, e in rows if keys is None or k in keys}
+
+    def rows(self, key):
+        with self.engine.begin() as db:
+            blob = self._execute(db, 'select landed_rows from %(table)s where item_key = :key',
+                                 {'key': key}).scalar()
+        return loads(zlib.decompress(blob))
+
+
+class _Transaction(object):
+    """Commits (or rolls back) and closes a SqliteQueue connection."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, excType, exc, tb):
+        try:
+            self.db.execute('commit' if excType is None else 'rollback')
+        finally:
+            self.db.close()
+
+
+def openQueue(url):
+    """Returns the work queue for a URL: a PostgreSQL or MySQL URL, sqlite:///path or memory."""
+    if url.startswith('sqlite:///'):
+        return SqliteQueue(url[len('sqlite:///'):])
+    if url.split(':', 1)[0].split('+', 1)[0] in ('postgresql', 'mysql', 'mariadb'):
+        return SqlQueue(url)
+    if url in ('memory', 'memory:'):
+        return MemoryQueue()
+    raise ValueError('Unsupported queue URL: %s' % url)
+
+
+class LeaseKeeper(object):
+    """Renews a lease in the background while its item is being fetched."""
+
+    def __init__(self, queue, key, token, seconds=LEASE_SECONDS):
+        self.queue = queue
+        self.key = key
+        self.token = token
+        self.seconds = seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.seconds / 3.0):
+            if not self.queue.renew(self.key, self.token, self.seconds):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def runWorker(queue, fetch, until=None, log=print, leaseSeconds=LEASE_SECONDS,
+              poll=POLL_SECONDS, idle=IDLE_SECONDS):
+    """Leases, fetches and lands items until there is nothing left to do.
+
+    Args:
+        queue: Work queue
+        fetch: Called with a work item, returns the partition's rows
+        until: Called when nothing can be leased; the worker stops once it
+            returns True. By default it stops when no item has been pending or
+            leased for `idle` seconds.
+        log: Progress logger
+        leaseSeconds: Lease length, renewed while an item is being fetched
+        poll: Seconds to wait before trying again while others hold leases
+        idle: Seconds an empty queue is waited on, without `until`
+    Returns:
+        The number of items this worker landed.
+    """
+    worker = workerName()
+    landed = 0
+    idleSince = None
+    while True:
+        lease = queue.lease(worker, leaseSeconds)
+        if lease is None:
+            if until is not None:
+                if until():
+                    return landed
+            elif any(s in (PENDING, LEASED) for s, e in queue.status().values()):
+                idleSince = None
+            elif idleSince is None:
+                idleSince = time.time()
+            elif time.time() - idleSince >= idle:
+                return landed
+            time.sleep(poll)
+            continue
+        idleSince = None
+
+        key, item, token = lease
+        try:
+            with LeaseKeeper(queue, key, token, leaseSeconds):
+                rows = fetch(item)
+        except QuotaExhausted as e:
+            # Not the item's fault: give it back untouched for a worker with quota left
+            queue.fail(key, token, repr(e), retry=False)
+            raise
+        except Exception as e:
+            log('%s: %r' % (key, e))
+            queue.fail(key, token, repr(e))
+            continue
+        if queue.complete(key, token, rows):
+            landed += 1
+        else:
+            log('%s: lease lost, rows dropped' % key)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Reporting API V4 quota limits
+#
+# Ref: https://developers.google.com/analytics/devguides/reporting/core/v4/limits-quotas
+#
+# A QuotaScheduler is shared by every fetch in a run. It spaces requests with
+# a token bucket, charges each one against the daily project and view quotas
+# before it is sent, and persists the day's usage so later runs on the same
+# day start from the right count. Open-month refreshes are let through ahead
+# of historical backfill.
+#
+# The day's counts live in a SQLite ledger shared by every process on the
+# host: each request re-reads them and adds one in a single write
+# transaction, so an intraday cron or several workers running alongside a
+# backfill all count against the same quota.
+
+import datetime as dt
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# Requests per 100 seconds per project
+PROJECT_REQUESTS_PER_100S = 2000
+# Requests per 100 seconds per user (a service account is one user)
+USER_REQUESTS_PER_100S = 100
+# Requests per day per project
+PROJECT_REQUESTS_PER_DAY = 50000
+# Requests per day per view
+VIEW_REQUESTS_PER_DAY = 10000
+# Concurrent requests per view
+VIEW_CONCURRENT_REQUESTS = 10
+
+QUOTA_LEDGER = os.path.join(os.path.expanduser('~'), '.cache', 'google_analytics_extract',
+                            'quota.db')
+# Seconds a process waits for another one's ledger transaction
+LEDGER_TIMEOUT = 60
+# Ledger scope of the project-wide count, views are counted under their id
+PROJECT_SCOPE = ''
+
+LEDGER_SCHEMA = '''
+create table if not exists usage (
+    day text, scope text, requests integer,
+    primary key (day, scope));
+'''
+
+PRIORITY_REFRESH = 0
+PRIORITY_BACKFILL = 1
+
+
+class QuotaExhausted(Exception):
+    """Raised when a request would exceed a daily quota."""
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+    Tokens refill continuously at `rate` per second up to `capacity`.
+    `reserve()` takes tokens immediately and returns how long the caller
+    must wait before using them, so it works for both threads
+    (`time.sleep`) and coroutines (`asyncio.sleep`).
+
+    Args:
+        rate: Tokens added per second
+        capacity: Maximum burst size
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, n=1):
+        """Returns the seconds until `n` tokens are available, without taking them."""
+        with self._lock:
+            self._refill()
+            return max(0.0, (n - self._tokens) / self.rate)
+
+    def reserve(self, n=1):
+        """Takes `n` tokens and returns the seconds to wait before spending them."""
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, n=1):
+        """Blocks until `n` tokens are available."""
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    def drain(self):
+        """Empties the bucket, e.g. after the API answered with a rate limit error."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+
+def quotaDay():
+    """Returns the current quota day. GA quotas reset at midnight Pacific time."""
+    try:
+        from zoneinfo import ZoneInfo
+        now = dt.datetime.now(ZoneInfo('America/Los_Angeles'))
+    except Exception:
+        now = dt.datetime.utcnow() - dt.timedelta(hours=8)
+    return now.date().isoformat()
+
+
+def datePriority(s_dt):
+    """Returns the scheduling priority for a request starting at `s_dt`.
+
+    Args:
+        s_dt: Start Date, 'YYYY-MM-DD' or a relative GA date such as 'today'
+    Returns:
+        PRIORITY_REFRESH for the open (current) month, PRIORITY_BACKFILL otherwise.
+    """
+    try:
+        start = dt.datetime.strptime(s_dt, '%Y-%m-%d').date()
+    except ValueError:
+        # '7daysago', 'today', ... are always recent
+        return PRIORITY_REFRESH
+    today = dt.date.today()
+    if (start.year, start.month) == (today.year, today.month):
+        return PRIORITY_REFRESH
+    return PRIORITY_BACKFILL
+
+
+class QuotaScheduler(object):
+    """Run-wide request scheduler for the Reporting API.
+
+    Args:
+        ledgerPath: SQLite file holding the day's request counts, shared with
+            other processes; None to keep them in memory
+        requestsPer100s: Sustained request rate, defaults to the stricter of the
+            per-user and per-project limits
+        burst: Requests allowed back to back
+        projectPerDay: Daily project quota
+        viewPerDay: Daily quota per view
+        headroom: Fraction of each daily quota held back for other clients
+    """
+
+    def __init__(self, ledgerPath=QUOTA_LEDGER,
+                 requestsPer100s=min(USER_REQUESTS_PER_100S, PROJECT_REQUESTS_PER_100S),
+                 burst=VIEW_CONCURRENT_REQUESTS, projectPerDay=PROJECT_REQUESTS_PER_DAY,
+                 viewPerDay=VIEW_REQUESTS_PER_DAY, headroom=0.05):
+        self.ledgerPath = ledgerPath
+        self.bucket = TokenBucket(requestsPer100s / 100.0, burst)
+        self.projectLimit = int(projectPerDay * (1 - headroom))
+        self.viewLimit = int(viewPerDay * (1 - headroom))
+        # Requests sent by this run, by report name
+        self.runUsage = Counter()
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        if ledgerPath:
+            os.makedirs(os.path.dirname(os.path.abspath(ledgerPath)), exist_ok=True)
+        # Transactions are begun explicitly, see _spend
+        self._db = sqlite3.connect(ledgerPath or ':memory:', timeout=LEDGER_TIMEOUT,
+                                   isolation_level=None, check_same_thread=False)
+        self._db.executescript(LEDGER_SCHEMA)
+        self._readLedger()
+
+    def _readLedger(self):
+        """Loads the day's counts of every process into `project` and `views`."""
+        self.day = quotaDay()
+        counts = dict(self._db.execute('select scope, requests from usage where day=?',
+                                       (self.day,)))
+        self.project = counts.pop(PROJECT_SCOPE, 0)
+        self.views = Counter(counts)
+
+    def _spend(self, viewId, report):
+        # The write lock is taken before reading, so no other process can
+        # count the same request slot in between
+        self._db.execute('begin immediate')
+        try:
+            self._readLedger()
+            if self.project + 1 > self.projectLimit:
+                raise QuotaExhausted('Daily project quota of %d requests used up'
+                                     % self.projectLimit)
+            if self.views[viewId] + 1 > self.viewLimit:
+                raise QuotaExhausted('Daily quota of %d requests used up for view %s'
+                                     % (self.viewLimit, viewId))
+            self._db.execute('delete from usage where day<>?', (self.day,))
+            for scope in (PROJECT_SCOPE, str(viewId)):
+                self._db.execute('insert or ignore into usage values (?, ?, 0)',
+                                 (self.day, scope))
+                self._db.execute('update usage set requests=requests+1 where day=? and scope=?',
+                                 (self.day, scope))
+            self._db.execute('commit')
+        except BaseException:
+            self._db.execute('rollback')
+            raise
+        self.project += 1
+        self.views[str(viewId)] += 1
+        self.runUsage[report] += 1
+
+    def remaining(self, viewId):
+        """Returns the requests left today for a view, counting every process's requests."""
+        with self._cond:
+            self._readLedger()
+            return min(self.projectLimit - self.project, self.viewLimit - self.views[str(viewId)])
+
+    def acquire(self, viewId, priority=PRIORITY_BACKFILL, report=None):
+        """Blocks until a request may be sent and charges it to the daily quotas.
+
+        Waiting callers are served by priority, then arrival order, so a
+        refresh that arrives late still goes ahead of queued backfill.
+
+        Args:
+            viewId: GA view the request is for
+            priority: PRIORITY_REFRESH or PRIORITY_BACKFILL
+            report: Report name, for the per-run usage summary
+        Raises:
+            QuotaExhausted: The request would exceed a daily quota.
+        """
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            self._cond.notify_all()
+            try:
+                while True:
+                    if self._waiting[0] == ticket:
+                        wait = self.bucket.delay()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                self.bucket.reserve()
+                self._spend(viewId, report)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def throttled(self):
+        """Backs off after the API answered with a rate limit error."""
+        self.bucket.drain()
+
+    def summary(self):
+        """Returns the day's usage and this run's requests by report."""
+        with self._cond:
+            self._readLedger()
+            return {'day': self.day, 'project': self.project, 'views': dict(self.views),
+                    'run': dict(self.runUsage)}
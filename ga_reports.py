@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Report specs
+#
+# One entry per GA table. The sync fetchers in google_analytics.py and the
+# async client in ga_async.py both build their batchGet bodies from these,
+# so a report's metrics and dimensions are declared in one place. Each spec
+# also has the first date to pull, the ga_enrich custom fields to add and
+# the table's indexes as (name, columns, unique). The custom fields come
+# from the ga_enrich plugins listed in 'plugins', by default those of the
+# spec's 'enrich' kind in ENRICH_PLUGINS. Tables also get the indexes
+# ga_indexes derives from the dashboard queries in 'queries', by default
+# those of the spec's kind in DASHBOARD_QUERIES.
+#
+# Specs can also carry server-side filters so rows the tables don't use
+# never leave GA. 'dimensionFilters' and 'metricFilters' are lists of
+# clauses that must all hold; a clause is a list of (name, operator,
+# expression) filters of which any one must match. Path filters are built
+# from the same patterns ga_enrich extracts ids with.
+#
+# Every report uses SEGMENT_ID unless its spec sets its own 'segment';
+# ga_merge only fetches reports together when their segments match.
+
+import re
+
+SEGMENT_ID = '<SEGMENT_ID>'
+PAGE_SIZE = 100000
+SAMPLING_LEVEL = 'LARGE'
+
+# DataFrame/table column for each dimension and metric. Dimensions without
+# an entry (ga:segment) are requested but not stored.
+COLUMN_NAMES = {
+    'ga:country': 'Country',
+    'ga:hostname': 'Hostname',
+    'ga:pagePath': 'Page',
+    'ga:pageTitle': 'PageTitle',
+    'ga:year': 'Year',
+    'ga:yearMonth': 'MonthofYear',
+    'ga:exitPagePath': 'ExitPage',
+    'ga:previousPagePath': 'PreviousPagePath',
+    'ga:dimension1': 'UserRole',
+    'ga:uniquePageviews': 'UniquePageviews',
+    'ga:users': 'Users',
+    'ga:sessions': 'Sessions',
+    'ga:exits': 'Exits',
+    'ga:searchExits': 'SearchExits',
+    'ga:searchRefinements': 'SearchRefinements',
+    'ga:searchResultViews': 'SearchResultViews',
+    'ga:searchSessions': 'SearchSessions',
+    'ga:searchUniques': 'SearchUniques',
+}
+# Dimensions with a handful of distinct values, stored as categoricals
+CATEGORICAL_DIMENSIONS = {'ga:country', 'ga:hostname', 'ga:dimension1'}
+# Dimensions holding integers
+INTEGER_DIMENSIONS = {'ga:year', 'ga:yearMonth'}
+# Metrics that can't be summed across date ranges, see ga_aggregate
+NON_ADDITIVE_METRICS = {'ga:users'}
+# Specs with 'yearColumn' get a Year column computed from ga:yearMonth
+# instead of requesting ga:year
+YEAR_COLUMN = 'Year'
+# Specs with 'viewColumn' get the view id and segment id each row was fetched
+# from, see ga_targets
+VIEW_COLUMN = 'ViewId'
+SEGMENT_COLUMN = 'Segment'
+
+# Patterns ga_enrich extracts article, locale and ticket ids with
+ARTICLE_ID = r'^.*articles\/([0-9]{12})'
+LOCALE_CODE = r'\/hc\/(en-us|es|zh-cn|ja|pt)\/'
+TICKET_ID = r'^.*requests\/([0-9]{3,6})'
+
+# ga_enrich plugins of each 'enrich' kind, in the order their columns are added
+ENRICH_PLUGINS = {
+    'article': ['clearDynamicSegment', 'articleIds', 'ticketId', 'date', 'supportRegion'],
+    'deflection': ['exitPageIds', 'ticketId', 'date', 'supportRegion'],
+    'session': ['date', 'supportRegion'],
+}
+
+# Dashboard queries on the tables of each 'enrich' kind, see ga_indexes. Each
+# sums every metric of rows matching 'equal' columns (and the 'range' column
+# between two values), grouped by 'group' columns.
+DASHBOARD_QUERIES = {
+    'article': [
+        {'name': 'region_trend', 'equal': ['SupportRegion'], 'range': 'MonthofYear',
+         'group': ['MonthofYear']},
+        {'name': 'role_articles', 'equal': ['SupportRegion', 'UserRole'], 'range': 'MonthofYear',
+         'group': ['ArticleId']},
+        {'name': 'article_trend', 'equal': ['ArticleId'], 'group': ['MonthofYear']},
+        {'name': 'ticket_articles', 'equal': ['TicketId'], 'group': ['ArticleId']},
+    ],
+    'deflection': [
+        {'name': 'region_trend', 'equal': ['SupportRegion'], 'range': 'MonthofYear',
+         'group': ['MonthofYear']},
+        {'name': 'article_trend', 'equal': ['ArticleId_ExitPage'], 'group': ['MonthofYear']},
+        {'name': 'ticket_articles', 'equal': ['TicketId'], 'group': ['ArticleId_ExitPage']},
+    ],
+    'session': [
+        {'name': 'region_trend', 'equal': ['SupportRegion'], 'range': 'MonthofYear',
+         'group': ['MonthofYear']},
+        {'name': 'role_trend', 'equal': ['SupportRegion', 'UserRole'], 'range': 'MonthofYear',
+         'group': ['MonthofYear']},
+    ],
+}
+
+# Set to False to fetch every row of the segment, as before filters were added
+SERVER_FILTERS = True
+
+
+def serverRegex(pattern):
+    """Turns an extraction pattern into a GA REGEXP filter expression.
+
+    GA regular expressions match anywhere in the value and don't need `/`
+    escaped, so the leading `^.*` and the escapes are dropped to stay well
+    inside GA's expression length limit.
+    """
+    return re.sub(r'^\^\.\*', '', pattern).replace('\\/', '/')
+
+
+def anyMetric(metrics):
+    """Returns a metric filter clause keeping rows where any of `metrics` is non-zero."""
+    return [(m, 'GREATER_THAN', '0') for m in metrics]
+
+
+# Custom dimension User Role added in Feb 2019
+START_DATE = '2019-03-01'
+# Ticket Submit button added Feb 2020
+BUTTON_START_DATE = '2020-02-01'
+
+REPORTS = {
+    'articledata': {
+        'metrics': ['ga:uniquePageviews', 'ga:users', 'ga:sessions'],
+        'dimensions': ['ga:country', 'ga:hostname', 'ga:pagePath', 'ga:pageTitle',
+                       'ga:yearMonth', 'ga:previousPagePath', 'ga:dimension1', 'ga:segment'],
+        'start': START_DATE,
+        'enrich': 'article',
+        # Only article pages have an ArticleId
+        'dimensionFilters': [[('ga:pagePath', 'REGEXP', serverRegex(ARTICLE_ID))]],
+        'indexes': [('GA_INDEX_01', ['index'], False),
+                    ('GA_INDEX_02', ['MonthofYear'], False)],
+    },
+    'articledeflectiondata': {
+        'metrics': ['ga:exits', 'ga:sessions', 'ga:uniquePageviews', 'ga:users'],
+        'dimensions': ['ga:country', 'ga:exitPagePath', 'ga:hostname', 'ga:pageTitle',
+                       'ga:yearMonth', 'ga:previousPagePath', 'ga:dimension1', 'ga:segment'],
+        'start': START_DATE,
+        'enrich': 'deflection',
+        # Sessions that left from an article
+        'dimensionFilters': [[('ga:exitPagePath', 'REGEXP', serverRegex(ARTICLE_ID))]],
+        'indexes': [('GA_INDEX_03', ['index'], True),
+                    ('GA_INDEX_04', ['MonthofYear'], False)],
+    },
+    'selfservicescoredata': {
+        'metrics': ['ga:sessions', 'ga:users', 'ga:searchExits', 'ga:searchRefinements',
+                    'ga:searchResultViews', 'ga:searchSessions', 'ga:searchUniques'],
+        'dimensions': ['ga:country', 'ga:hostname', 'ga:yearMonth',
+                       'ga:dimension1', 'ga:segment'],
+        'yearColumn': True,
+        'start': START_DATE,
+        'enrich': 'session',
+        'indexes': [('GA_INDEX_07', ['index'], True),
+                    ('GA_INDEX_08', ['MonthofYear'], False)],
+    },
+    'ticketuserdata': {
+        'metrics': ['ga:sessions', 'ga:users'],
+        'dimensions': ['ga:country', 'ga:hostname', 'ga:yearMonth', 'ga:dimension1',
+                       'ga:segment'],
+        'start': START_DATE,
+        'enrich': 'session',
+        'indexes': [('GA_INDEX_09', ['index'], True),
+                    ('GA_INDEX_10', ['MonthofYear'], False)],
+    },
+    'ticketformdefl': {
+        'metrics': ['ga:exits', 'ga:sessions', 'ga:users'],
+        'dimensions': ['ga:country', 'ga:exitPagePath', 'ga:hostname', 'ga:pageTitle',
+                       'ga:yearMonth', 'ga:previousPagePath', 'ga:dimension1', 'ga:segment'],
+        'start': START_DATE,
+        'enrich': 'deflection',
+        'indexes': [('GA_INDEX_11', ['index'], True),
+                    ('GA_INDEX_12', ['MonthofYear'], False)],
+    },
+    'ticketformsession': {
+        'metrics': ['ga:sessions', 'ga:users'],
+        'dimensions': ['ga:country', 'ga:hostname', 'ga:yearMonth',
+                       'ga:dimension1', 'ga:segment'],
+        'yearColumn': True,
+        'start': BUTTON_START_DATE,
+        'enrich': 'session',
+        'indexes': [('GA_INDEX_13', ['index'], True),
+                    ('GA_INDEX_14', ['MonthofYear'], False)],
+    },
+    'missedticketformdefl': {
+        'metrics': ['ga:exits', 'ga:sessions', 'ga:users'],
+        'dimensions': ['ga:country', 'ga:exitPagePath', 'ga:hostname', 'ga:pageTitle',
+                       'ga:yearMonth', 'ga:previousPagePath', 'ga:dimension1', 'ga:segment'],
+        'start': BUTTON_START_DATE,
+        'enrich': 'deflection',
+        'indexes': [('GA_INDEX_15', ['index'], True),
+                    ('GA_INDEX_16', ['MonthofYear'], False)],
+    },
+    'missedselfservicedefl': {
+        'metrics': ['ga:exits', 'ga:sessions', 'ga:users'],
+        'dimensions': ['ga:country', 'ga:exitPagePath', 'ga:hostname', 'ga:pageTitle',
+                       'ga:yearMonth', 'ga:previousPagePath', 'ga:dimension1', 'ga:segment'],
+        'start': START_DATE,
+        'enrich': 'deflection',
+        'indexes': [('GA_INDEX_17', ['index'], True),
+                    ('GA_INDEX_18', ['MonthofYear'], False)],
+    },
+}
+
+for name, spec in REPORTS.items():
+    spec['name'] = name
+    spec.setdefault('segment', SEGMENT_ID)
+    spec.setdefault('dimensionFilters', [])
+    spec.setdefault('plugins', list(ENRICH_PLUGINS[spec['enrich']]))
+    spec.setdefault('queries', DASHBOARD_QUERIES[spec['enrich']])
+    # Rows where every metric is zero add nothing to any table
+    spec.setdefault('metricFilters', [anyMetric(spec['metrics'])])
+
+
+def filterClauses(clauses, kind):
+    """Builds Reporting API V4 dimension or metric filter clauses.
+
+    Args:
+        clauses: A spec's 'dimensionFilters' or 'metricFilters'
+        kind: 'dimension' or 'metric'
+    Returns:
+        A list of DimensionFilterClause or MetricFilterClause dicts.
+    """
+    result = []
+    for clause in clauses:
+        filters = []
+        for name, operator, expression in clause:
+            if kind == 'dimension':
+                filters.append({'dimensionName': name, 'operator': operator,
+                                'expressions': [expression]})
+            else:
+                filters.append({'metricName': name, 'operator': operator,
+                                'comparisonValue': expression})
+        result.append({'operator': 'OR', 'filters': filters})
+    return result
+
+
+def describeFilters(spec):
+    """Returns a one-line summary of a spec's server-side filters, '' if it has none."""
+    clauses = []
+    for clause in spec['dimensionFilters'] + spec['metricFilters']:
+        clauses.append(' or '.join('%s %s %s' % f for f in clause))
+    return ' and '.join('(%s)' % c if len(clauses) > 1 else c for c in clauses)
+
+
+def reportRequest(spec, viewId, s_dt, e_dt, token = None):
+    """Builds the reportRequests entry for a report spec.
+
+    Args:
+        spec: Report spec from REPORTS
+        viewId: GA view to query
+        s_dt: Start Date
+        e_dt: End Date
+        token: nextPageToken
+    Returns:
+        A Reporting API V4 ReportRequest dict.
+    """
+    request = {
+        'viewId': viewId,
+        'pageToken': token,
+        'pageSize': PAGE_SIZE,
+        'samplingLevel': SAMPLING_LEVEL,
+        'dateRanges': [{'startDate': s_dt, 'endDate': e_dt}],
+        'segments': [{'segmentId': spec['segment']}],
+        'metrics': [{'expression': m} for m in spec['metrics']],
+        'dimensions': [{'name': d} for d in spec['dimensions']],
+    }
+    if SERVER_FILTERS:
+        if spec['dimensionFilters']:
+            request['dimensionFilterClauses'] = filterClauses(spec['dimensionFilters'], 'dimension')
+        if spec['metricFilters']:
+            request['metricFilterClauses'] = filterClauses(spec['metricFilters'], 'metric')
+    return request
+
+
+def batchGetBody(spec, viewId, s_dt, e_dt, token = None):
+    """Returns the batchGet request body for a single report spec."""
+    return {'reportRequests': [reportRequest(spec, viewId, s_dt, e_dt, token)]}
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Compact rows
+#
+# A batchGet row is {'dimensions': [...], 'metrics': [{'values': [...]}]}:
+# two dicts and three lists per row, and a fresh string for every value,
+# before anything has been converted. Each page is turned into
+# (dimensions, values) tuples as soon as it arrives and the response dicts
+# are dropped, so months accumulate at a fraction of the size. Values of
+# low-cardinality dimensions (country, hostname, user role, month, segment)
+# and metric values, mostly small numbers, are interned, so the thousands of
+# rows that repeat one share a single string. Paths and titles are not
+# interned: most of them are seen once.
+#
+# Everything downstream (fingerprints, merges, projections, frames) reads
+# row[0] as the dimensions and row[1] as the metric values, in spec order.
+# Checkpointed pages and landed queue items are stored as JSON
+# [dimensions, values] pairs and read back with compactRows too. Pages
+# checkpointed as full response rows by earlier versions are converted the
+# same way.
+
+import sys
+
+from ga_reports import CATEGORICAL_DIMENSIONS, INTEGER_DIMENSIONS
+
+# Dimensions whose values repeat across most rows
+SHARED_DIMENSIONS = CATEGORICAL_DIMENSIONS | INTEGER_DIMENSIONS | {'ga:segment'}
+
+
+def compactRows(spec, rows):
+    """Converts API rows, or stored [dimensions, values] pairs, to (dimensions, values) tuples.
+
+    Args:
+        spec: Report spec (or ga_merge merged spec) the rows were fetched with
+        rows: Rows of the Analytics Reporting API V4 response, or pairs
+    Returns:
+        A list of (dimensions tuple, metric values tuple).
+    """
+    intern = sys.intern
+    shared = [d in SHARED_DIMENSIONS for d in spec['dimensions']]
+    compact = []
+    for row in rows:
+        if isinstance(row, dict):
+            dimensions, values = row['dimensions'], row['metrics'][0]['values']
+        else:
+            dimensions, values = row
+        compact.append((tuple([intern(d) if s else d for d, s in zip(dimensions, shared)]),
+                        tuple([intern(v) for v in values])))
+    return compact
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Where report tables are written
+#
+# A sink replaces a report's table, or some months of it, and keeps the
+# ga_fingerprint fingerprints of what it holds. openSink() picks one from
+# the database URL:
+#
+# * mysql+...://      LOAD DATA LOCAL INFILE from a tab separated file
+# * postgresql://     COPY ... FROM STDIN
+# * sqlite:///        executemany on a WAL mode database
+# * parquet:///dir    one Parquet dataset per report, partitioned by month
+# * anything else SQLAlchemy can connect to goes through DataFrame.to_sql
+#
+# Every write takes a DataFrame or, for a frame ga_spill spilled to disk, an
+# iterable of DataFrame chunks that are written one after another.
+#
+# Tables are created from an empty frame with every integer column declared
+# BIGINT, so a table first created from a month of small values (a
+# downcast uint8 column) doesn't overflow when later months are appended.
+# Text columns that are part of an index are declared
+# VARCHAR(INDEXED_TEXT_LENGTH) rather than TEXT, which MySQL can't index
+# without a prefix (and a prefix index can't cover a query).
+#
+# SQL sinks keep a pool of POOL_SIZE connections, checked with a ping before
+# use and replaced after POOL_RECYCLE seconds, so loads of several tables
+# can run at once (google_analytics.py --load-workers) on connections of
+# their own. Every connection gets the sink's BULK_SETTINGS when it is
+# opened. A load is one transaction unless COMMIT_ROWS is set; then rows
+# are committed every COMMIT_ROWS rows, and a load that fails halfway
+# leaves its months without fingerprints so the next run writes them again.
+#
+# bench_sinks.py compares their load throughput.
+
+import json
+import os
+import shutil
+import tempfile
+
+from ga_fingerprint import forgetFingerprints, loadedFingerprints, saveFingerprints
+
+# Rows converted to text, or bound, per batch
+CHUNK_ROWS = 50000
+# Rows written per transaction, None for one transaction per load
+COMMIT_ROWS = None
+# Connections each SQL sink keeps open, one per table loaded in parallel
+POOL_SIZE = 4
+# Seconds before a pooled connection is replaced, below the server's idle timeout
+POOL_RECYCLE = 3600
+# Client side packet limit for MySQL (pymysql), the server's max_allowed_packet still applies
+MAX_ALLOWED_PACKET = 1 << 30
+# Length of indexed text columns, short enough for a few of them to fit one MySQL index key
+INDEXED_TEXT_LENGTH = 128
+MONTH_COLUMN = 'MonthofYear'
+INDEX_COLUMN = 'index'
+NULL = '\\N'
+
+
+def iterFrames(df):
+    """Returns the chunks of a DataFrame or ga_spill.SpilledFrame."""
+    return [df] if hasattr(df, 'columns') else df
+
+
+def columnTypes(df, indexes=()):
+    """Returns to_sql dtypes declaring every integer column BIGINT and indexed text columns VARCHAR."""
+    from sqlalchemy.types import BigInteger, String
+
+    indexed = {c for name, columns, unique in indexes for c in columns}
+    types = {}
+    for c in df.columns:
+        if df[c].dtype.kind in 'iu':
+            types[c] = BigInteger()
+        elif c in indexed and (df[c].dtype.kind == 'O' or df[c].dtype.name == 'category'):
+            types[c] = String(INDEXED_TEXT_LENGTH)
+    return types
+
+
+def escapeText(s):
+    """Escapes strings for MySQL LOAD DATA / PostgreSQL COPY text format."""
+    return (s.astype(object).astype(str)
+            .str.replace('\\', '\\\\', regex=False)
+            .str.replace('\t', '\\t', regex=False)
+            .str.replace('\n', '\\n', regex=False)
+            .str.replace('\r', '\\r', regex=False))
+
+
+def textColumn(s):
+    """Formats a column for MySQL LOAD DATA / PostgreSQL COPY text format."""
+    kind = s.dtype.kind
+    if kind == 'M':
+        text = s.dt.strftime('%Y-%m-%d %H:%M:%S')
+    elif kind in 'iuf':
+        text = s.astype(str)
+    elif s.dtype.name == 'category':
+        # Each value in use is escaped once and spread out by its code
+        s = s.cat.remove_unused_categories()
+        text = s.cat.rename_categories(escapeText(s.cat.categories.to_series()).tolist())
+        text = text.astype(object)
+    else:
+        text = escapeText(s)
+    return text.where(s.notna(), NULL)
+
+
+def writeText(df, f):
+    """Writes `df` to a binary file as tab separated text, NULL as \\N, a chunk at a time."""
+    for start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        columns = [textColumn(chunk[c]) for c in chunk.columns]
+        lines = columns[0].str.cat(columns[1:], sep='\t')
+        f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+class CommitBatches(object):
+    """Runs a load on one connection, committing every `commitRows` rows written.
+
+    Args:
+        connection: SQLAlchemy connection the load runs on
+        commitRows: Rows per transaction, None for a single transaction
+    """
+
+    def __init__(self, connection, commitRows=COMMIT_ROWS):
+        self.connection = connection
+        self.commitRows = commitRows
+        self.pending = 0
+        self._transaction = None
+
+    def __enter__(self):
+        self._transaction = self.connection.begin()
+        return self
+
+    def split(self, df):
+        """Returns `df` in pieces of at most commitRows rows."""
+        if not self.commitRows or len(df) <= self.commitRows:
+            return [df]
+        return [df.iloc[start:start + self.commitRows]
+                for start in range(0, len(df), self.commitRows)]
+
+    def wrote(self, rows):
+        """Counts written rows, committing once a batch is full."""
+        self.pending += rows
+        if self.commitRows and self.pending >= self.commitRows:
+            self._transaction.commit()
+            self._transaction = self.connection.begin()
+            self.pending = 0
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self._transaction.commit()
+        else:
+            self._transaction.rollback()
+
+
+class SqlSink(object):
+    """Writes report tables to any database SQLAlchemy can connect to.
+
+    Rows go through DataFrame.to_sql; subclasses override writeRows() with
+    the database's bulk load path and BULK_SETTINGS with the session
+    settings that speed it up.
+
+    Args:
+        url: SQLAlchemy database URL
+        engineArgs: Passed to create_engine
+    """
+
+    # Statements run on every new connection
+    BULK_SETTINGS = []
+    # Whether several tables can be loaded at once
+    parallel = True
+
+    def __init__(self, url, **engineArgs):
+        from sqlalchemy import create_engine, event
+
+        self.url = url
+        engineArgs.setdefault('pool_pre_ping', True)
+        engineArgs.setdefault('pool_recycle', POOL_RECYCLE)
+        self.engine = create_engine(url, **self.poolArgs(url, engineArgs))
+        self.quote = self.engine.dialect.identifier_preparer.quote
+        self.commitRows = COMMIT_ROWS
+
+        def applySettings(dbapiConnection, record):
+            cursor = dbapiConnection.cursor()
+            for statement in self.BULK_SETTINGS:
+                cursor.execute(statement)
+            cursor.close()
+            dbapiConnection.commit()
+
+        if self.BULK_SETTINGS:
+            event.listen(self.engine, 'connect', applySettings)
+
+    def poolArgs(self, url, engineArgs):
+        """Returns create_engine arguments with the pool size added, if the engine's pool has one.
+
+        Only QueuePool takes a size: SQLite file databases get NullPool, and
+        an explicit `poolclass` is left as it is.
+        """
+        from sqlalchemy.engine.url import make_url
+        from sqlalchemy.pool import QueuePool
+
+        if 'poolclass' in engineArgs:
+            return engineArgs
+        parsed = make_url(url)
+        if issubclass(parsed.get_dialect().get_pool_class(parsed), QueuePool):
+            engineArgs.setdefault('pool_size', POOL_SIZE)
+        return engineArgs
+
+    def hasTable(self, report):
+        with self.engine.connect() as connection:
+            return self.engine.dialect.has_table(connection, report)
+
+    def loadedFingerprints(self, report):
+        """Returns (fingerprint, row count) of the months in a report's table, keyed by (year, month)."""
+        with self.engine.begin() as connection:
+            return loadedFingerprints(connection, report)
+
+    def createTable(self, connection, report, df, indexes=()):
+        df.head(0).to_sql(report, connection, index=False, dtype=columnTypes(df, indexes))
+
+    def createIndexes(self, connection, report, indexes):
+        for name, columns, unique in indexes:
+            connection.execute('create %sindex %s on %s(%s)' % (
+                'unique ' if unique else '', self.quote(name), self.quote(report),
+                ', '.join(self.quote(c) for c in columns)))
+
+    def writeRows(self, connection, report, df):
+        df.to_sql(report, connection, index=False, chunksize=10000, if_exists='append')
+
+    def replaceTable(self, report, df, indexes, fingerprints=None):
+        """Replaces a report's table with `df`.
+
+        Args:
+            report: Report name
+            df: DataFrame holding the whole table
+            indexes: The report's (name, columns, unique) indexes
+            fingerprints: ga_fingerprint fingerprints of the months in `df`
+        """
+        with self.engine.connect() as connection, CommitBatches(connection,
+                                                                  self.commitRows) as batches:
+            connection.execute('drop table if exists %s' % self.quote(report))
+            forgetFingerprints(connection, report)
+            for i, frame in enumerate(iterFrames(df)):
+                if i == 0:
+                    self.createTable(connection, report, frame, indexes)
+                for part in batches.split(frame):
+                    self.writeRows(connection, report, part)
+                    batches.wrote(len(part))
+            self.createIndexes(connection, report, indexes)
+            saveFingerprints(connection, report, fingerprints or {})
+
+    def replaceMonths(self, report, df, months, indexes, fingerprints=None):
+        """Replaces some months of a report's table with `df`, creating the table if needed.
+
+        `index` values in `df` are shifted past those already in the table.
+
+        Args:
+            report: Report name
+            df: DataFrame holding exactly the months being replaced
+            months: List of (year, month) tuples
+            indexes: The report's (name, columns, unique) indexes
+            fingerprints: ga_fingerprint fingerprints of `months`
+        """
+        with self.engine.connect() as connection, CommitBatches(connection,
+                                                                  self.commitRows) as batches:
+            exists = self.engine.dialect.has_table(connection, report)
+            shift = 0
+            if exists:
+                connection.execute('delete from %s where %s in (%s)' % (
+                    self.quote(report), self.quote(MONTH_COLUMN),
+                    ', '.join('%04d%02d' % ym for ym in months)))
+                shift = connection.execute(
+                    'select coalesce(max(%s) + 1, 0) from %s'
+                    % (self.quote(INDEX_COLUMN), self.quote(report))).scalar()
+            # Written again below once every row is in
+            forgetFingerprints(connection, report, months)
+            for i, frame in enumerate(iterFrames(df)):
+                frame[INDEX_COLUMN] += shift
+                if i == 0 and not exists:
+                    self.createTable(connection, report, frame, indexes)
+                for part in batches.split(frame):
+                    self.writeRows(connection, report, part)
+                    batches.wrote(len(part))
+            if not exists:
+                self.createIndexes(connection, report, indexes)
+            if fingerprints:
+                saveFingerprints(connection, report, fingerprints)
+
+    def close(self):
+        self.engine.dispose()
+
+
+class MySQLSink(SqlSink):
+    """Loads rows with LOAD DATA LOCAL INFILE. The server needs local_infile enabled."""
+
+    # The tables have no foreign keys and their only unique index is built after loading
+    BULK_SETTINGS = ['set session unique_checks=0', 'set session foreign_key_checks=0']
+
+    def __init__(self, url, **engineArgs):
+        connectArgs = engineArgs.setdefault('connect_args', {})
+        connectArgs.setdefault('local_infile', True)
+        if '+pymysql' in url.split('://', 1)[0]:
+            connectArgs.setdefault('max_allowed_packet', MAX_ALLOWED_PACKET)
+        SqlSink.__init__(self, url, **engineArgs)
+
+    def writeRows(self, connection, report, df):
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as f:
+            writeText(df, f)
+            f.flush()
+            cursor = connection.connection.cursor()
+            cursor.execute("load data local infile %%s into table %s character set utf8mb4 (%s)" % (
+                self.quote(report), ', '.join(self.quote(c) for c in df.columns)), (f.name,))
+            cursor.close()
+
+
+class PostgresSink(SqlSink):
+    """Loads rows with COPY ... FROM STDIN (psycopg2 or psycopg 3)."""
+
+    # A crash loses the last commits but never corrupts; indexes build in memory
+    BULK_SETTINGS = ['set synchronous_commit to off', "set maintenance_work_mem to '512MB'"]
+
+    def writeRows(self, connection, report, df):
+        sql = 'copy %s (%s) from stdin' % (self.quote(report),
+                                            ', '.join(self.quote(c) for c in df.columns))
+        with tempfile.TemporaryFile() as f:
+            writeText(df, f)
+            f.seek(0)
+            cursor = connection.connection.cursor()
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(sql, f)
+            else:
+                with cursor.copy(sql) as copy:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        copy.write(block)
+            cursor.close()
+
+
+class SQLiteSink(SqlSink):
+    """Loads rows with executemany on a database in WAL mode.
+
+    SQLite has a single writer, so tables are loaded one at a time.
+    """
+
+    BULK_SETTINGS = ['pragma journal_mode=wal', 'pragma synchronous=normal']
+    parallel = False
+
+    def writeRows(self, connection, report, df):
+        sql = 'insert into %s (%s) values (%s)' % (
+            self.quote(report), ', '.join(self.quote(c) for c in df.columns),
+            ', '.join('?' * len(df.columns)))
+        cursor = connection.connection.cursor()
+        for start in range(0, len(df), CHUNK_ROWS):
+            chunk = df.iloc[start:start + CHUNK_ROWS].copy()
+            for c in chunk.columns:
+                if chunk[c].dtype.kind == 'M':
+                    chunk[c] = chunk[c].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+            values = chunk.astype(object).where(chunk.notna(), None)
+            cursor.executemany(sql, values.itertuples(index=False, name=None))
+        cursor.close()
+
+
+class ParquetSink(object):
+    """Writes each report as a Parquet dataset partitioned by month.
+
+    Tables live in <root>/<report>/MonthofYear=YYYYMM/, fingerprints in
+    <root>/<report>/_fingerprints.json. Indexes don't apply and are ignored.
+
+    Args:
+        root: Directory holding the datasets
+    """
+
+    # Each report is a dataset of its own
+    parallel = True
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, report, *parts):
+        return os.path.join(self.root, report, *parts)
+
+    def hasTable(self, report):
+        return os.path.isdir(self._path(report))
+
+    def loadedFingerprints(self, report):
+        path = self._path(report, '_fingerprints.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return {(int(m[:4]), int(m[5:])): tuple(fp) for m, fp in json.load(f).items()}
+
+    def _saveFingerprints(self, report, fingerprints, months=None):
+        saved = {} if months is None else {
+            '%04d-%02d' % ym: fp for ym, fp in self.loadedFingerprints(report).items()
+            if ym not in months}
+        saved.update({'%04d-%02d' % ym: fp for ym, fp in (fingerprints or {}).items()})
+        path = self._path(report, '_fingerprints.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(saved, f, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def _write(self, report, df):
+        # Categorical columns carry the run's whole ga_vocab vocabulary; a
+        # month file only gets the categories its own rows use
+        categorical = [c for c in df.columns if df[c].dtype.name == 'category']
+        for month, part in df.groupby(MONTH_COLUMN, sort=False):
+            part = part.assign(**{c: part[c].cat.remove_unused_categories()
+                                  for c in categorical})
+            part.to_parquet(self._path(report), engine='pyarrow', index=False,
+                            partition_cols=[MONTH_COLUMN])
+
+    def replaceTable(self, report, df, indexes, fingerprints=None):
+        shutil.rmtree(self._path(report), ignore_errors=True)
+        for frame in iterFrames(df):
+            self._write(report, frame)
+        self._saveFingerprints(report, fingerprints)
+
+    def replaceMonths(self, report, df, months, indexes, fingerprints=None):
+        shift = 0
+        if self.hasTable(report):
+            for year, month in months:
+                shutil.rmtree(self._path(report, '%s=%04d%02d' % (MONTH_COLUMN, year, month)),
+                              ignore_errors=True)
+            import pandas as pd
+            try:
+                existing = pd.read_parquet(self._path(report), columns=[INDEX_COLUMN])
+            except (OSError, ValueError):
+                existing = None
+            if existing is not None and len(existing):
+                shift = int(existing[INDEX_COLUMN].max()) + 1
+        for frame in iterFrames(df):
+            frame[INDEX_COLUMN] += shift
+            self._write(report, frame)
+        self._saveFingerprints(report, fingerprints, months)
+
+    def close(self):
+        pass
+
+
+def openSink(url):
+    """Returns the sink for a database URL, see the module comment."""
+    scheme = url.split(':', 1)[0].split('+', 1)[0]
+    if scheme == 'parquet':
+        return ParquetSink(url.split('://', 1)[1] or '.')
+    if scheme in ('mysql', 'mariadb'):
+        return MySQLSink(url)
+    if scheme == 'postgresql':
+        return PostgresSink(url)
+    if scheme == 'sqlite':
+        return SQLiteSink(url)
+    return SqlSink(url)
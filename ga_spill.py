@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Building report frames that may not fit in memory
+#
+# A FrameAccumulator converts a report's rows to DataFrame chunks as each
+# month arrives, so the response dicts of a month are freed before the next
+# one is added, instead of every month's dicts, columns and the finished
+# frame being alive at once. Chunks stay in memory until SPILL_ROWS rows
+# have been converted. Past that, every chunk is written to a spill file
+# and the result is a SpilledFrame: enrichment and loading then run one
+# chunk at a time, and only one chunk is ever in memory.
+#
+# With pyarrow installed the spill file is an Arrow IPC file that is read
+# back memory-mapped, so a chunk costs no copy until pandas converts it.
+# Without it each chunk is pickled to a file of its own. Arrow needs one
+# schema for the whole file, so integer columns are spilled as float64
+# (exact up to 2**53) and turned back into int64 when a chunk has no
+# missing values; categoricals are spilled as strings and encoded with the
+# run's ga_vocab vocabulary again when read back.
+
+import os
+import tempfile
+
+import ga_frames
+from ga_frames import CHUNK_ROWS, chunkFrame, concatFrames, rssBytes
+from ga_vocab import vocabulary
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Rows held in memory before a report's frame is spilled to disk
+SPILL_ROWS = 2000000
+# Directory for spill files, the system temp dir by default
+SPILL_DIR = None
+
+
+def arrowSchema(chunk):
+    """Returns the Arrow schema every spilled chunk of a report is written with."""
+    fields = []
+    for name, dtype in chunk.dtypes.items():
+        fields.append(pa.field(name, pa.float64() if dtype.kind in 'iuf' else pa.string()))
+    return pa.schema(fields)
+
+
+def arrowBatch(chunk, schema):
+    """Converts a chunk to a record batch with the spill schema."""
+    columns = []
+    for field in schema:
+        values = chunk[field.name]
+        if pa.types.is_string(field.type):
+            values = values.astype(object).where(values.notna(), None)
+        else:
+            values = values.astype('float64')
+        columns.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+class SpilledFrame(object):
+    """A report frame spilled to disk, read back one chunk at a time.
+
+    Iterating yields the chunks as DataFrames indexed by their row numbers
+    in the whole frame, passed through `transform` when one is set. len() is
+    the number of rows.
+
+    Args:
+        directory: tempfile.TemporaryDirectory holding the spill files
+        rows: Number of rows
+        ints: Columns that were integers before spilling
+        categoricals: Columns that were vocabulary categoricals before spilling
+    """
+
+    def __init__(self, directory, rows, ints, categoricals=()):
+        self.directory = directory
+        self.rows = rows
+        self.ints = ints
+        self.categoricals = categoricals
+        self.transform = None
+
+    def __len__(self):
+        return self.rows
+
+    def _chunks(self):
+        import pandas as pd
+
+        path = os.path.join(self.directory.name, 'frame.arrow')
+        if pa is not None and os.path.exists(path):
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    chunk = reader.get_batch(i).to_pandas()
+                    for name in self.ints:
+                        if not chunk[name].isna().any():
+                            chunk[name] = chunk[name].astype('int64')
+                    for name in self.categoricals:
+                        chunk[name] = vocabulary.categorical(name, chunk[name].tolist())
+                    yield chunk
+            return
+        for name in sorted(os.listdir(self.directory.name)):
+            yield pd.read_pickle(os.path.join(self.directory.name, name))
+
+    def __iter__(self):
+        offset = 0
+        for chunk in self._chunks():
+            chunk.index = chunk.index + offset
+            offset += len(chunk)
+            yield self.transform(chunk) if self.transform else chunk
+
+    def close(self):
+        """Deletes the spill files."""
+        self.directory.cleanup()
+
+
+class FrameAccumulator(object):
+    """Converts a report's rows to a DataFrame as they arrive, spilling to disk when it grows too big.
+
+    Args:
+        spec: Report spec the frame is built for
+        validator: ga_validate.PartitionValidator handed each chunk
+        spillRows: Rows held in memory before spilling, SPILL_ROWS by default
+        spillDir: Directory for spill files, SPILL_DIR by default
+    """
+
+    def __init__(self, spec, validator=None, spillRows=None, spillDir=None):
+        self.spec = spec
+        self.validator = validator
+        # The module settings are read here, so they can be changed at runtime
+        self.spillRows = SPILL_ROWS if spillRows is None else spillRows
+        self.spillDir = SPILL_DIR if spillDir is None else spillDir
+        self.pending = []
+        self.chunks = []
+        self.rows = 0
+        self.peak = rssBytes()
+        self._spill = None
+        self._written = 0
+        self._sink = None
+        self._writer = None
+        self._schema = None
+        self._ints = []
+        self._categoricals = []
+
+    def add(self, rows):
+        """Adds rows, converting every full chunk. `rows` can be dropped afterwards."""
+        self.pending.extend(rows)
+        while len(self.pending) >= CHUNK_ROWS:
+            self._convert(self.pending[:CHUNK_ROWS])
+            del self.pending[:CHUNK_ROWS]
+
+    def _convert(self, rows):
+        chunk = chunkFrame(self.spec, rows)
+        if self.validator is not None:
+            self.validator.addChunk(chunk)
+        self.rows += len(chunk)
+        self.chunks.append(chunk)
+        if self._spill is None and self.rows > self.spillRows:
+            self._spill = tempfile.TemporaryDirectory(prefix='ga_spill', dir=self.spillDir)
+        if self._spill is not None:
+            for chunk in self.chunks:
+                self._write(chunk)
+            self.chunks = []
+        self.peak = max(self.peak, rssBytes())
+
+    def _write(self, chunk):
+        if pa is None:
+            chunk.to_pickle(os.path.join(self._spill.name, '%08d.pkl' % self._written))
+            self._written += 1
+            return
+        if self._writer is None:
+            self._schema = arrowSchema(chunk)
+            self._ints = [name for name, dtype in chunk.dtypes.items() if dtype.kind in 'iu']
+            self._categoricals = [name for name, dtype in chunk.dtypes.items()
+                                  if dtype.name == 'category']
+            self._sink = pa.OSFile(os.path.join(self._spill.name, 'frame.arrow'), 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self._schema)
+        self._writer.write_batch(arrowBatch(chunk, self._schema))
+
+    def result(self):
+        """Converts what is left and returns (frame, stats).
+
+        The frame is a DataFrame, or a SpilledFrame once more than
+        `spillRows` rows were added. stats has the row count, in-memory frame
+        size and peak process size in MB, whether the peak went over
+        ga_frames.MEMORY_BUDGET_MB and whether the frame was spilled.
+        """
+        if self.pending or not self.rows:
+            self._convert(self.pending)
+            self.pending = []
+
+        mb = 1024.0 * 1024.0
+        if self._spill is None:
+            frame = concatFrames(self.chunks)
+            self.chunks = []
+            frameMb = round(frame.memory_usage(deep=True).sum() / mb, 1)
+        else:
+            if self._writer is not None:
+                self._writer.close()
+                self._sink.close()
+            frame = SpilledFrame(self._spill, self.rows, self._ints, self._categoricals)
+            frameMb = 0.0
+        self.peak = max(self.peak, rssBytes())
+        peakMb = round(self.peak / mb, 1)
+        return frame, {'rows': self.rows, 'frame_mb': frameMb, 'peak_rss_mb': peakMb,
+                       'over_budget': peakMb > ga_frames.MEMORY_BUDGET_MB,
+                       'spilled': self._spill is not None}
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Fetching every report from several views
+#
+# A run can pull the same reports from several help-center views. Each
+# (view, segment) target gets its own copy of a report's spec, named
+# 'report@view' (or 'report@view:segment'), so pages, finished months and
+# quota usage are checkpointed and counted per target. Every target's months
+# go through the same worker pool and QuotaScheduler, which already keeps a
+# daily count per view.
+#
+# With more than one target, each row is tagged with the view and segment it
+# came from and the tables get ViewId and Segment columns, so all targets
+# load into the same tables, two segments of one view included. A month of a table holds the rows of every target of the run, so
+# keep the target list the same between runs of a table.
+
+from ga_reports import REPORTS
+
+
+def parseTarget(value):
+    """Parses a 'VIEW' or 'VIEW:SEGMENT' command line target into (view, segment)."""
+    view, _, segment = value.partition(':')
+    return (view, segment or None)
+
+
+def targetSpec(spec, target, default):
+    """Returns the spec a report (or ga_merge merged spec) is fetched with for a target.
+
+    Args:
+        spec: Report spec from REPORTS or ga_merge.mergedSpec
+        target: (view, segment) tuple, segment None for the spec's own
+        default: The target the plain spec is fetched for
+    Returns:
+        `spec` itself for the default target, otherwise a copy naming the
+        target's view and segment.
+    """
+    if target == default:
+        return spec
+    view, segment = target
+    name = '%s@%s' % (spec['name'], view) + (':%s' % segment if segment else '')
+    return dict(spec, name=name, viewId=view, segment=segment or spec['segment'])
+
+
+def viewSpec(report, targets):
+    """Returns the spec a report's tables are built with: tagged by view when there are several targets."""
+    spec = REPORTS[report]
+    if len(targets) < 2:
+        return spec
+    return dict(spec, viewColumn=True)
+
+
+def tagRows(rows, view, segment):
+    """Appends the view and segment ids to each row's dimensions, where ga_frames reads them for 'viewColumn' specs."""
+    tag = (view, segment)
+    return [(dimensions + tag, values) for dimensions, values in rows]
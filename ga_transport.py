@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Wire format for batchGet responses
+#
+# A 100,000 row page is mostly repeated JSON keys and quoted numbers, so it
+# compresses well and costs more to parse than to fetch. Google only gzips a
+# response when the request both accepts gzip and has "gzip" in its
+# User-Agent. `fields` asks for a partial response holding just the rows,
+# paging fields, totals and sampling counts; minimums, maximums and column
+# headers aren't used.
+# Responses and checkpointed pages are decoded with orjson when it is
+# installed, and with the standard library otherwise.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+USER_AGENT = 'google-analytics-extract (gzip)'
+# Partial response mask for reports:batchGet
+RESPONSE_FIELDS = ('reports(nextPageToken,'
+                   'data(rows(dimensions,metrics(values)),totals(values),rowCount,'
+                   'samplesReadCounts,samplingSpaceSizes))')
+
+
+def loads(content):
+    """Decodes JSON from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(content)
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def dumps(obj):
+    """Encodes an object as UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
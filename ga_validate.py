@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Data-quality checks for each loaded partition
+#
+# A PartitionValidator is handed every chunk ga_spill.FrameAccumulator
+# converts, so the checks ride along with the conversion instead of reading
+# the data again. Per (report, month) it counts rows, sums metrics, counts missing
+# values (a metric that didn't parse is NaN) and 'Dynamic Segment' user
+# roles. check() then compares them with:
+#
+# * the totals GA reported for each date range (saved in the checkpoint by
+#   get_reportData): a mismatch means pages went missing
+# * the row count of the month's previous load: a big swing is suspicious
+# * GA's sampling counts: a sampled month isn't exact
+#
+# Each partition's metrics and warnings go into the run report main()
+# writes at the end of the run.
+
+from ga_reports import COLUMN_NAMES, NON_ADDITIVE_METRICS
+
+MONTH_COLUMN = 'MonthofYear'
+USER_ROLE_COLUMN = 'UserRole'
+DYNAMIC_SEGMENT = 'Dynamic Segment'
+# ga_enrich plugin that replaces 'Dynamic Segment' with NaN
+DYNAMIC_SEGMENT_CLEARED = 'clearDynamicSegment'
+# Warn when a month's row count moves by more than this fraction
+ROW_DELTA_WARN = 0.5
+# Warn when more than this fraction of a dimension column is missing
+NULL_RATIO_WARN = 0.01
+# Relative difference allowed between summed rows and GA's totals
+TOTALS_TOLERANCE = 1e-6
+
+
+def windowMeta(spec, report):
+    """Extracts what ga_validate needs from the first page of a date range.
+
+    Args:
+        spec: Report spec the request was built from
+        report: A report of the Analytics Reporting API V4 response
+    Returns:
+        A JSON-serializable dict with totals by metric name, rowCount and
+        sampling counts.
+    """
+    data = report.get('data', {})
+    totals = data.get('totals') or [{}]
+    return {
+        'totals': dict(zip(spec['metrics'], totals[0].get('values', []))),
+        'rowCount': data.get('rowCount'),
+        'samplesRead': sum(int(v) for v in data.get('samplesReadCounts', [])),
+        'samplingSpace': sum(int(v) for v in data.get('samplingSpaceSizes', [])),
+    }
+
+
+class PartitionValidator(object):
+    """Collects per-month statistics from a report's frame chunks and checks them.
+
+    Args:
+        spec: Report spec from ga_reports.REPORTS
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.metrics = [(m, COLUMN_NAMES[m]) for m in spec['metrics']]
+        self.months = {}
+
+    def addChunk(self, chunk):
+        """Accumulates a converted chunk's statistics by month."""
+        if not len(chunk):
+            return
+        month = chunk[MONTH_COLUMN]
+        counts = month.value_counts()
+        sums = chunk[[c for m, c in self.metrics]].groupby(month).sum()
+        nulls = chunk.isna().groupby(month).sum()
+        if USER_ROLE_COLUMN in chunk:
+            dynamic = (chunk[USER_ROLE_COLUMN] == DYNAMIC_SEGMENT).groupby(month).sum()
+        else:
+            dynamic = {}
+        for ym, count in counts.items():
+            stats = self.months.setdefault(int(ym), {
+                'rows': 0, 'sums': dict.fromkeys(sums.columns, 0.0),
+                'nulls': dict.fromkeys(nulls.columns, 0), 'dynamic_segment': 0})
+            stats['rows'] += int(count)
+            for c, v in sums.loc[ym].items():
+                stats['sums'][c] += float(v)
+            for c, v in nulls.loc[ym].items():
+                stats['nulls'][c] += int(v)
+            stats['dynamic_segment'] += int(dynamic.get(ym, 0))
+
+    def check(self, year, month, metas=None, previousRows=None):
+        """Checks one month against GA's totals, sampling counts and the previous load.
+
+        Args:
+            year: Year
+            month: Month
+            metas: windowMeta() of each date range the month was fetched in
+            previousRows: Row count of the month's previous load, None if it is new
+        Returns:
+            A dict of the month's metrics with a list of 'warnings'.
+        """
+        stats = self.months.get(year * 100 + month, {
+            'rows': 0, 'sums': {}, 'nulls': {}, 'dynamic_segment': 0})
+        rows = stats['rows']
+        warnings = []
+        result = {
+            'report': self.spec['name'],
+            'month': '%04d-%02d' % (year, month),
+            'rows': rows,
+            'previous_rows': previousRows,
+            'dynamic_segment': stats['dynamic_segment'],
+            'null_ratios': {c: round(float(n) / rows, 4)
+                            for c, n in stats['nulls'].items() if n and rows},
+            'sampled': False,
+            'warnings': warnings,
+        }
+
+        metricColumns = set(c for m, c in self.metrics)
+        for column, ratio in sorted(result['null_ratios'].items()):
+            if column in metricColumns:
+                warnings.append('%s: %d value(s) did not parse as numbers'
+                                % (column, stats['nulls'][column]))
+            elif ratio > NULL_RATIO_WARN:
+                warnings.append('%s: %.1f%% missing' % (column, ratio * 100))
+        if stats['dynamic_segment'] and DYNAMIC_SEGMENT_CLEARED not in self.spec['plugins']:
+            warnings.append("%s: %d row(s) with '%s'"
+                            % (USER_ROLE_COLUMN, stats['dynamic_segment'], DYNAMIC_SEGMENT))
+
+        if previousRows and abs(rows - previousRows) > ROW_DELTA_WARN * previousRows:
+            warnings.append('rows: %d, %d at the previous load' % (rows, previousRows))
+
+        if metas and all(metas):
+            samplesRead = sum(m['samplesRead'] for m in metas)
+            samplingSpace = sum(m['samplingSpace'] for m in metas)
+            if samplingSpace:
+                result['sampled'] = True
+                result['sampling_ratio'] = round(float(samplesRead) / samplingSpace, 4)
+                warnings.append('sampled: %.1f%% of sessions read'
+                                % (100.0 * samplesRead / samplingSpace))
+            for metric, column in self.metrics:
+                if metric in NON_ADDITIVE_METRICS:
+                    # Per-range totals of users can't be added up
+                    continue
+                values = [m['totals'].get(metric) for m in metas]
+                if None in values:
+                    continue
+                expected = sum(float(v) for v in values)
+                actual = stats['sums'].get(column, 0.0)
+                if abs(actual - expected) > TOTALS_TOLERANCE * max(abs(expected), 1.0):
+                    warnings.append('%s: rows sum to %s, GA totals %s'
+                                    % (column, repr(actual), repr(expected)))
+        return result
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # One categorical vocabulary for every report of a run
+#
+# Country, Hostname, UserRole, PageTitle, ViewId and Segment hold the same
+# strings in every report and every month. Instead of each chunk of each report
+# building categories of its own, every value is looked up in the run's
+# Vocabulary, which keeps one string per distinct value and gives it a code
+# for good. A chunk's column is then Categorical.from_codes over the
+# vocabulary's categories so far: every report's frames share those string
+# objects and, while the vocabulary hasn't grown, the very same dtype.
+#
+# Codes are only ever appended, so the categories of an earlier chunk are a
+# prefix of a later one's and chunks are concatenated without recoding any
+# values. Sinks that write text format each category once and spread it out
+# by code instead of formatting every row.
+
+import threading
+
+import pandas as pd
+
+from ga_reports import CATEGORICAL_DIMENSIONS, COLUMN_NAMES, SEGMENT_COLUMN, VIEW_COLUMN
+
+# Dimensions encoded with the run's vocabulary
+VOCABULARY_DIMENSIONS = CATEGORICAL_DIMENSIONS | {'ga:pageTitle'}
+# Columns encoded with the run's vocabulary
+VOCABULARY_COLUMNS = ({COLUMN_NAMES[d] for d in VOCABULARY_DIMENSIONS}
+                      | {VIEW_COLUMN, SEGMENT_COLUMN})
+
+
+class Vocabulary(object):
+    """Codes for the distinct values of each column, shared by every report of a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._codes = {}
+        self._dtypes = {}
+
+    def categorical(self, column, values):
+        """Encodes a list of strings as a Categorical over the column's vocabulary.
+
+        Args:
+            column: Column name, e.g. 'Country'
+            values: The column's values; missing values are not allowed
+        Returns:
+            A pd.Categorical whose categories are every value of `column` seen so far.
+        """
+        with self._lock:
+            codes = self._codes.setdefault(column, {})
+            add = codes.setdefault
+            encoded = [add(v, len(codes)) for v in values]
+            dtype = self._dtypes.get(column)
+            if dtype is None or len(dtype.categories) != len(codes):
+                dtype = self._dtypes[column] = pd.CategoricalDtype(list(codes))
+        return pd.Categorical.from_codes(encoded, dtype=dtype)
+
+    def sizes(self):
+        """Returns the number of distinct values of each column."""
+        with self._lock:
+            return {column: len(codes) for column, codes in self._codes.items()}
+
+
+# The run's vocabulary
+vocabulary = Vocabulary()
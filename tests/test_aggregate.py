@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Spilled and in-memory aggregation merge date ranges the same way
+#
+# Feeds ga_aggregate.mergeWindows the same made-up date ranges twice, once
+# with room for every group and once with a maxGroups small enough to spill
+# to disk, and compares the merged rows and counts. Needs no third-party
+# packages. Run with `python -m unittest discover tests`.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ga_aggregate import mergeWindows
+
+SPEC = {'dimensions': ['ga:country', 'ga:hostname'], 'metrics': ['ga:sessions', 'ga:users']}
+
+
+def makeWindows(seed, windows=4, rows=300, keys=120):
+    """Date ranges of rows over `keys` dimension tuples, some repeated within a range."""
+    rng = random.Random(seed)
+    result = []
+    for window in range(windows):
+        picked = rng.sample(range(keys), min(rows, keys))
+        current = [(('Country%d' % k, 'host%d' % (k % 7)),
+                    (str(rng.randint(0, 50)), str(rng.randint(0, 20)))) for k in picked]
+        # A page stored twice repeats its rows within the range
+        current += current[:rng.randint(0, 10)]
+        result.append(current)
+    return result
+
+
+class SpillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spillDir = tempfile.mkdtemp(prefix='test_aggregate')
+
+    def tearDown(self):
+        shutil.rmtree(self.spillDir, ignore_errors=True)
+
+    def merged(self, windows, **kwargs):
+        rows, stats = mergeWindows(SPEC, iter(windows), spillDir=self.spillDir, **kwargs)
+        return dict(rows), stats
+
+    def expected(self, windows):
+        """Merges the ranges the slow way: sum sessions, max users, skip repeats in a range."""
+        result = {}
+        for current in windows:
+            seen = set()
+            for dimensions, (sessions, users) in current:
+                if dimensions in seen:
+                    continue
+                seen.add(dimensions)
+                old = result.get(dimensions)
+                if old is None:
+                    result[dimensions] = (sessions, users)
+                else:
+                    result[dimensions] = (str(int(old[0]) + int(sessions)),
+                                          max(old[1], users, key=float))
+        return result
+
+    def test_spilled_matches_memory(self):
+        for seed in range(5):
+            windows = makeWindows(seed)
+            memory, memoryStats = self.merged(windows)
+            spilled, spilledStats = self.merged(windows, maxGroups=8)
+            self.assertEqual(memoryStats['spilled'], 0)
+            self.assertGreater(spilledStats['spilled'], 0)
+            self.assertEqual(spilled, memory)
+            self.assertEqual(memory, self.expected(windows))
+            for key in ('rows', 'windows', 'duplicates', 'merged', 'non_additive'):
+                self.assertEqual(spilledStats[key], memoryStats[key], key)
+
+    def test_single_range(self):
+        windows = makeWindows(7, windows=1)
+        memory, memoryStats = self.merged(windows)
+        spilled, spilledStats = self.merged(windows, maxGroups=8)
+        self.assertEqual(spilled, memory)
+        self.assertEqual(memory, self.expected(windows))
+        self.assertEqual(spilledStats['duplicates'], memoryStats['duplicates'])
+        self.assertEqual(memoryStats['merged'], 0)
+
+    def test_spill_files_removed(self):
+        rows, stats = mergeWindows(SPEC, iter(makeWindows(3)), maxGroups=8, spillDir=self.spillDir)
+        self.assertTrue(os.listdir(self.spillDir))
+        list(rows)
+        self.assertEqual(os.listdir(self.spillDir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Leases of the work queues
+#
+# Runs the same checks against each ga_queue backend: a lease that ran out
+# goes to the next worker, the worker that lost it can neither renew it nor
+# land rows, an item that keeps failing is marked failed, and runWorker lands
+# what it fetches. SqlQueue is run over a SQLite URL, which needs SQLAlchemy.
+# Run with `python -m unittest discover tests`.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ga_queue
+from ga_queue import DONE, FAILED, LEASED, MAX_ATTEMPTS, PENDING, itemKey, runWorker
+
+
+def workItem(month):
+    return {'view': '123', 'segment': None, 'report': 'ticketuserdata', 'year': 2020,
+            'month': month}
+
+
+class QueueTests(object):
+    """Checks shared by every backend; subclasses set up self.queue."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_queue')
+        self.queue = self.makeQueue()
+
+    def tearDown(self):
+        engine = getattr(self.queue, 'engine', None)
+        if engine is not None:
+            engine.dispose()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_expired_lease_released(self):
+        self.queue.enqueue([workItem(1)])
+        key, item, token = self.queue.lease('first', seconds=0.2)
+        self.assertEqual(item, workItem(1))
+        self.assertIsNone(self.queue.lease('second'))
+        time.sleep(0.5)
+        lease = self.queue.lease('second')
+        self.assertIsNotNone(lease)
+        self.assertEqual(lease[0], key)
+        self.assertNotEqual(lease[2], token)
+
+    def test_lost_token_cannot_complete(self):
+        self.queue.enqueue([workItem(1)])
+        key, item, token = self.queue.lease('first', seconds=0.2)
+        time.sleep(0.5)
+        key, item, current = self.queue.lease('second')
+        self.assertFalse(self.queue.renew(key, token))
+        self.assertFalse(self.queue.complete(key, token, [(('a',), ('1',))]))
+        self.assertEqual(self.queue.status()[key][0], LEASED)
+        self.assertTrue(self.queue.renew(key, current))
+        self.assertTrue(self.queue.complete(key, current, [(('b',), ('2',))]))
+        self.assertEqual(self.queue.status()[key][0], DONE)
+        self.assertEqual(self.queue.rows(key), [[['b'], ['2']]])
+
+    def test_failed_after_max_attempts(self):
+        self.queue.enqueue([workItem(1)])
+        for attempt in range(MAX_ATTEMPTS):
+            key, item, token = self.queue.lease('worker')
+            self.queue.fail(key, token, 'boom %d' % attempt)
+        self.assertEqual(self.queue.status()[key], (FAILED, 'boom %d' % (MAX_ATTEMPTS - 1)))
+        self.assertIsNone(self.queue.lease('worker'))
+
+    def test_fail_without_retry(self):
+        self.queue.enqueue([workItem(1)])
+        for attempt in range(MAX_ATTEMPTS + 1):
+            key, item, token = self.queue.lease('worker')
+            self.queue.fail(key, token, 'quota', retry=False)
+        self.assertEqual(self.queue.status()[key][0], PENDING)
+
+    def test_run_worker(self):
+        items = [workItem(m) for m in (1, 2, 3)]
+        self.queue.enqueue(items)
+
+        def fetch(item):
+            if item['month'] == 2:
+                raise ValueError('bad month')
+            return [((str(item['month']),), ('10',))]
+
+        landed = runWorker(self.queue, fetch, until=lambda: True, log=lambda message: None,
+                           poll=0)
+        self.assertEqual(landed, 2)
+        status = self.queue.status()
+        self.assertEqual(status[itemKey(items[0])][0], DONE)
+        self.assertEqual(status[itemKey(items[1])][0], FAILED)
+        self.assertEqual(status[itemKey(items[2])][0], DONE)
+        self.assertEqual(self.queue.rows(itemKey(items[2])), [[['3'], ['10']]])
+
+
+class MemoryQueueTest(QueueTests, unittest.TestCase):
+
+    def makeQueue(self):
+        return ga_queue.MemoryQueue()
+
+
+class SqliteQueueTest(QueueTests, unittest.TestCase):
+
+    def makeQueue(self):
+        return ga_queue.SqliteQueue(os.path.join(self.workdir, 'queue.db'))
+
+
+class SqlQueueTest(QueueTests, unittest.TestCase):
+
+    def makeQueue(self):
+        return ga_queue.SqlQueue('sqlite:///' + os.path.join(self.workdir, 'queue.db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Backfills of a month range keep the table's other months
+#
+# Runs google_analytics.main against a temporary SQLite database and
+# checkpoint, with getMonthData returning made-up rows instead of calling GA.
+# Needs pandas and SQLAlchemy. Run with `python -m unittest discover tests`.
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google_analytics as ga
+from ga_quota import QuotaScheduler
+from ga_reports import REPORTS
+
+REPORT = 'ticketuserdata'
+
+
+class SubrangeBackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_sync')
+        self.database = os.path.join(self.workdir, 'ga.db')
+        self.saved = (ga.CHECKPOINT_DIR, ga.RUN_REPORT, ga.getMonthData)
+        ga.CHECKPOINT_DIR = os.path.join(self.workdir, 'checkpoints')
+        ga.RUN_REPORT = os.path.join(ga.CHECKPOINT_DIR, 'run_report.json')
+        ga.checkpoint = None
+        ga.sink = None
+        ga.scheduler = QuotaScheduler(os.path.join(self.workdir, 'quota.db'))
+        del ga.runReport[:]
+        # Sessions of each fetched month, changed by the tests between runs
+        self.sessions = {}
+        ga.getMonthData = self.monthData
+
+    def tearDown(self):
+        ga.CHECKPOINT_DIR, ga.RUN_REPORT, ga.getMonthData = self.saved
+        if ga.sink is not None:
+            ga.sink.close()
+        ga.checkpoint = ga.sink = ga.scheduler = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def monthData(self, year, month, report, target=ga.DEFAULT_TARGET, hours=None):
+        values = {'ga:country': 'Japan', 'ga:hostname': 'help.example.com',
+                  'ga:yearMonth': '%04d%02d' % (year, month), 'ga:dimension1': 'Admin',
+                  'ga:segment': 'Segment'}
+        sessions = self.sessions.get((year, month), 10)
+        return [(tuple(values[d] for d in REPORTS[report]['dimensions']),
+                 (str(sessions), str(i + 1))) for i in range(3)]
+
+    def backfill(self, start, end):
+        ga.main(['backfill', '-r', REPORT, '--start', start, '--end', end,
+                 '--database', 'sqlite:///' + self.database])
+
+    def tableMonths(self):
+        connection = sqlite3.connect(self.database)
+        try:
+            return dict(connection.execute(
+                'select MonthofYear, sum(Sessions) from %s group by MonthofYear' % REPORT))
+        finally:
+            connection.close()
+
+    def test_changed_month(self):
+        self.backfill('2020-01', '2020-03')
+        self.assertEqual(self.tableMonths(), {202001: 30, 202002: 30, 202003: 30})
+        self.sessions[(2020, 2)] = 20
+        self.backfill('2020-02', '2020-02')
+        self.assertEqual(self.tableMonths(), {202001: 30, 202002: 60, 202003: 30})
+
+    def test_unchanged_month(self):
+        self.backfill('2020-01', '2020-03')
+        self.backfill('2020-02', '2020-02')
+        self.assertEqual(self.tableMonths(), {202001: 30, 202002: 30, 202003: 30})
+
+
+if __name__ == '__main__':
+    unittest.main()